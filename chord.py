@@ -1,16 +1,29 @@
+import bisect
 import functools
+import heapq
 import uuid
 import threading
-import hashlib
 import time
 import inspect
 import os
 import signal
+import socket
+import urllib.parse
+import json
+import base64
+import traceback
 
-import requests
 from flask import Flask, request, jsonify, current_app
 
 import schemas
+from http_pool import SessionPool
+from dispatch import Dispatcher, Batcher
+from stream_transport import StreamServer, StreamSender
+from location_cache import LocationCache
+from membership import Membership
+import storage
+import transfer
+from storage import Replica
 
 def with_kwargs(func):
     sig = inspect.signature(func)
@@ -24,27 +37,121 @@ def with_kwargs(func):
         return func(*args, **kwargs, _kwargs=_kwargs)
     return inner
 
-def send_request(url, endpoint, data, nonblocking=True):
+session_pool = SessionPool(
+        max_destinations = int(os.environ.get("HTTP_POOL_MAX_DESTINATIONS", "64")),
+        max_connections  = int(os.environ.get("HTTP_POOL_MAX_CONNECTIONS", "32")),
+        idle_timeout     = float(os.environ.get("HTTP_POOL_IDLE_TIMEOUT", "60")),
+        )
+
+# fire-and-forget messages give up on a destination that does not connect, or answer, in time
+# (seconds), instead of holding a dispatcher worker (or the handler that runs a message itself) forever.
+DISPATCH_CONNECT_TIMEOUT = float(os.environ.get("DISPATCH_CONNECT_TIMEOUT", "3"))
+DISPATCH_READ_TIMEOUT    = float(os.environ.get("DISPATCH_READ_TIMEOUT", "30"))
+
+def post_request(full_url, data, on_miss=None, timeout=None):
+    if on_miss is None:
+        session_pool.post(full_url, json=data, timeout=timeout)
+        return
+    # routed request: a node that is gone (no connection, a timeout, or nginx/its manager answering
+    # 502/503/504 for it) is a routing miss. Errors of a live node are not.
+    try:
+        resp = session_pool.post(full_url, json=data, timeout=timeout)
+        missed = resp.status_code in (502, 503, 504)
+    except Exception:
+        missed = True
+    if missed:
+        on_miss()
+
+def dispatch_request(full_url, data, on_miss=None):
+    post_request(full_url, data, on_miss, timeout=(DISPATCH_CONNECT_TIMEOUT, DISPATCH_READ_TIMEOUT))
+
+dispatcher = Dispatcher(dispatch_request,
+        workers                      = int(os.environ.get("DISPATCH_WORKERS", "32")),
+        max_queue_depth              = int(os.environ.get("DISPATCH_MAX_QUEUE_DEPTH", "1024")),
+        max_inflight_per_destination = int(os.environ.get("DISPATCH_MAX_INFLIGHT_PER_DESTINATION", "8")),
+        )
+
+def send_request(url, endpoint, data, nonblocking=True, on_miss=None):
     full_url = f"{url}/{endpoint}"
 
-    def do_request():
-        requests.post(full_url, json=data)
-
     if nonblocking:
-        thread = threading.Thread(target=do_request, daemon=False)
-        thread.start()
+        dispatcher.submit(url, full_url, data, on_miss)
     else:
-        do_request()
+        post_request(full_url, data, on_miss)
+
+def request_response(url, endpoint, data):
+    # blocking request that returns the "response" field of the reply
+    return session_pool.post(f"{url}/{endpoint}", json=data).json().get("response")
+
+# fix_fingers: every FIX_FINGERS_INTERVAL seconds, up to FIX_FINGERS_PER_ROUND fingers are looked up again
+FIX_FINGERS_INTERVAL  = float(os.environ.get("FIX_FINGERS_INTERVAL", "0.5"))
+FIX_FINGERS_PER_ROUND = int(os.environ.get("FIX_FINGERS_PER_ROUND", "4"))
+
+# membership gossip: every GOSSIP_INTERVAL seconds each node exchanges its table with GOSSIP_FANOUT random peers
+GOSSIP_INTERVAL          = float(os.environ.get("GOSSIP_INTERVAL", "1"))
+GOSSIP_FANOUT            = int(os.environ.get("GOSSIP_FANOUT", "2"))
+MEMBERSHIP_TIMEOUT       = float(os.environ.get("MEMBERSHIP_TIMEOUT", "10"))
+MEMBERSHIP_TOMBSTONE_TTL = float(os.environ.get("MEMBERSHIP_TOMBSTONE_TTL", "60"))
+
+# failure handling: each node keeps SUCCESSOR_LIST_SIZE successors, probes its successor every HEARTBEAT_INTERVAL
+# seconds and fails over after HEARTBEAT_FAILURES unanswered probes. Operations give up after OPERATION_TIMEOUT seconds.
+SUCCESSOR_LIST_SIZE = int(os.environ.get("SUCCESSOR_LIST_SIZE", "3"))
+HEARTBEAT_INTERVAL  = float(os.environ.get("HEARTBEAT_INTERVAL", "1"))
+HEARTBEAT_TIMEOUT   = float(os.environ.get("HEARTBEAT_TIMEOUT", "1"))
+HEARTBEAT_FAILURES  = int(os.environ.get("HEARTBEAT_FAILURES", "3"))
+OPERATION_TIMEOUT   = float(os.environ.get("OPERATION_TIMEOUT", "10"))
+
+# log storage backend: every CHECKPOINT_INTERVAL seconds the node records which logs hold its replicas, with a
+# marker of its successor's change log, so that after a crash it rejoins with a delta instead of a full transfer
+CHECKPOINT_INTERVAL = float(os.environ.get("CHECKPOINT_INTERVAL", "10"))
+
+# a held ring lock is renewed every LOCK_RENEW_INTERVAL seconds, well within its lease (LOCK_LEASE of the locking service)
+LOCK_RENEW_INTERVAL = float(os.environ.get("LOCK_RENEW_INTERVAL", "30"))
+
+TRANSFER_CHUNK_BYTES       = int(os.environ.get("TRANSFER_CHUNK_BYTES", str(1024*1024)))
+TRANSFER_COMPRESSION_LEVEL = int(os.environ.get("TRANSFER_COMPRESSION_LEVEL", "1"))
+TRANSFER_RETRIES           = int(os.environ.get("TRANSFER_RETRIES", "5"))
+# a transfer that received no chunk for TRANSFER_IDLE_TIMEOUT seconds and was not claimed is dropped
+TRANSFER_IDLE_TIMEOUT      = float(os.environ.get("TRANSFER_IDLE_TIMEOUT", "300"))
+
+def send_chunk(url, transfer_id, replica_idx, chunk_idx, body):
+    # Retries until the receiver has applied this chunk. The receiver acknowledges with the
+    # next chunk it expects, so a chunk that was applied but whose reply got lost is not re-applied.
+    for attempt in range(TRANSFER_RETRIES):
+        try:
+            resp = session_pool.post(f"{url}/transferChunk", data=body,
+                    params={"transfer_id": transfer_id, "replica": replica_idx, "chunk": chunk_idx},
+                    headers={"Content-Type": "application/octet-stream"})
+            if resp.json()["response"] > chunk_idx:
+                return
+        except Exception as e:
+            print(f"Transfer {transfer_id} chunk {chunk_idx} failed (attempt {attempt+1}):", e, flush=True)
+        time.sleep(0.1 * 2**attempt)
+    raise RuntimeError(f"Transfer {transfer_id} to {url} failed.")
+
+def send_replicas(url, replicas_items):
+    # Streams replicas (iterables of (key, value), in hash order) to url as compressed chunks.
+    # Returns the transfer descriptor to be sent along with the request that uses them.
+    transfer_id = uuid.uuid4().hex
+    chunks = []
+    for replica_idx, items in enumerate(replicas_items):
+        chunks.append(0)
+        for chunk_idx, pairs in enumerate(transfer.iter_chunks(items, TRANSFER_CHUNK_BYTES)):
+            send_chunk(url, transfer_id, replica_idx, chunk_idx, transfer.encode_chunk(pairs, TRANSFER_COMPRESSION_LEVEL))
+            chunks[-1] += 1
+    return {"transfer_id": transfer_id, "replicas": len(replicas_items), "chunks": chunks}
 
 
 class ChordNode:
-    def __init__(self, url, locking_srv_url, replication_factor=None, consistency_model=None, is_bootstrap=False):
+    def __init__(self, url, locking_srv_url, replication_factor=None, consistency_model=None, transport=None,
+            stream_addr=None, is_bootstrap=False):
         self.url = url
         self.node_id = self.hash_id(url)
 
         self.locking_srv_url = locking_srv_url
 
         self.successor_url   = url if is_bootstrap else None
+        self.successor_id    = self.node_id if is_bootstrap else None
         self.predecessor_url = url if is_bootstrap else None
 
         self.is_bootstrap = is_bootstrap
@@ -55,8 +162,9 @@ class ChordNode:
         self.replication_factor = 1 if is_bootstrap else None
         self.max_replication_factor = replication_factor if is_bootstrap else None
 
-        self.data_store = [{}] if is_bootstrap else None
+        self.data_store = [Replica(durable=True)] if is_bootstrap else None
         self.consistency_model = consistency_model if is_bootstrap else None
+        self.transport = transport if is_bootstrap else None # "HTTP" or "STREAM", for replication traffic
 
         # Replication Example: Let the node No.4 be responsible for a key k and let replication factor be 3.
         # Then replicas must exist at nodes No.5 and No.6. The chain for chain replication is 4->5->6.
@@ -66,23 +174,107 @@ class ChordNode:
         # join/depart.
         # when join/depart we must ensure that replication factor is kept at k.
         # data_store[i] is the replica in distance i from the node responsible for a key.
-        # reads are performed at data_store[-1].
+        # reads are performed at data_store[-1] (or, for keys without uncommitted writes, at any replica. see self.dirty).
 
 
         self.seq_to_succ = 0
         self.seq_from_prev = 0
-        self.reorder_buffer_replication = dict()
+        self.reorder_buffer_replication = [] # min-heap of (seq, arrival counter, time buffered, op, kwargs)
+        self.reorder_arrivals = 0            # tiebreaker: kwargs are never compared
+        self.replicate_draining = False      # a single caller drains the buffer at a time
         self.replicate_wakeup_lock = threading.Lock()
+        self.reorder_stats = {"messages": 0, "reordered": 0, "dropped": 0, "max_depth": 0, "total_wait": 0.0, "max_wait": 0.0}
+
+        # STREAM transport: replication messages travel over one FIFO connection to the successor,
+        # so they always arrive in sequence order and the reorder buffer stays empty.
+        self.stream_addr = stream_addr
+        self.stream_server = None
+        self.succ_stream = None
+        # successor without a usable stream: (url, until). until None: it has no stream endpoint at all.
+        self.no_stream = (None, None)
+        self.peer_ips = set()         # addresses of the ring's hosts, allowed to send us frames
+        self.peer_ips_refreshed = 0.0
+
+        # group commit: the chain head coalesces concurrent writes into one replicateModifyBatch message.
+        self.write_batcher = Batcher(self.flush_write_batch,
+                max_size = int(os.environ.get("REPLICATION_BATCH_MAX_SIZE", "64")),
+                window   = float(os.environ.get("REPLICATION_BATCH_WINDOW_MS", "2")) / 1000,
+                )
+
+        # CRAQ (LINEARIZABLE): key -> newest version applied here but not yet committed at the tail.
+        # The replicas hold the newest value, so a key that is not dirty is clean and can be read at any
+        # replica of its chain. Commits travel from the tail back up the chain.
+        self.dirty = {}
+        self.dirty_lock = threading.Lock()
+        self.version = 0
+        self.craq_stats = {"clean_reads": 0, "chain_reads": 0}
+        self.commit_batcher = Batcher(self.flush_commits,
+                max_size = int(os.environ.get("REPLICATION_BATCH_MAX_SIZE", "64")),
+                window   = float(os.environ.get("REPLICATION_BATCH_WINDOW_MS", "2")) / 1000,
+                )
+
+        # keys changed here, so that a departed predecessor that rejoins gets only the changes.
+        self.change_log = storage.ChangeLog()
+        self.snapshot = None # (marker, replicas) left by a previous departure of this node
+
+        # (key range -> responsible node) learned from completed operations. cleared on membership changes.
+        self.location_cache = LocationCache(int(os.environ.get("LOCATION_CACHE_SIZE", "1024")))
 
         self.pending_requests = dict()
 
-        self.departed = False
+        # single-flight reads.
+        # LINEARIZABLE: key -> uid of the chain read this node started for a dirty key. Later reads of the key
+        # wait for its result, unless a write to the key has been applied here since (the write drops the entry).
+        # chain_lock orders starting a chain read against applying and forwarding writes.
+        # A chain read is given up after OPERATION_TIMEOUT (its waiters have timed out by then), so that a lost
+        # answer does not hold back later reads of the key. flight_deadlines: flight uid -> deadline, oldest first.
+        # EVENTUAL: key -> read in progress among the queries entering at this node.
+        # Both are cleared when the successor changes: later reads go through the new chain.
+        self.read_flights  = dict()
+        self.flight_deadlines = dict()
+        self.entry_flights = dict()
+        self.chain_lock    = threading.Lock()
+        self.flights_lock  = threading.Lock()
+        self.flight_stats  = {"chain_reads": 0, "coalesced": 0, "expired": 0, "entry_reads": 0, "entry_coalesced": 0}
+
+        # transfer_id -> list of {"replica", "next_chunk"}, filled by incoming chunks
+        self.incoming_transfers = dict()
+        self.transfer_deadlines = dict() # transfer_id -> when it is dropped unless a chunk arrives, oldest first
+        self.incoming_transfers_lock = threading.Lock()
 
+        self.departed = False
+        self.departed_to = None # node that took over our keys, once we have departed
+        self.checkpoint_lock = threading.Lock() # a checkpoint never overwrites the snapshot of the departure
+        self.lock_renewals = {} # lock_id -> event that stops the renewal of a lock we hold
+
+        # fingers[i]: url of the node responsible for node_id + 2**i, or None if unknown/stale.
+        # Maintained in the background by fix_fingers; routing correctness relies on the successor only.
+        # finger_table: the deduplicated (node_id, url) fingers, ordered by clockwise distance from this node.
+        # finger_dists holds those distances, for bisect.
+        self.fingers = [None] * 160
+        self.node_ids = {} # url -> node id, so that each node is hashed once
         self.finger_table = []
+        self.finger_dists = []
+        self.fingers_lock = threading.Lock()
+        self.next_finger = 0
+        self.finger_stats = {"lookups": 0, "changed": 0, "misses": 0}
+
+        # gossiped view of the ring: overlay answers from it, and finger tables are rebuilt from it
+        # when a node joins or leaves.
+        self.membership = Membership(url, timeout=MEMBERSHIP_TIMEOUT, tombstone_ttl=MEMBERSHIP_TOMBSTONE_TTL)
+
+        # the next SUCCESSOR_LIST_SIZE nodes (refreshed by the heartbeat), to fail over to when the successor dies
+        self.successor_list = [self.successor_url] if is_bootstrap else []
+        self.failover_lock = threading.Lock()
+        # set when a request routed to the successor missed: wakes up the heartbeat thread
+        self.successor_suspect = threading.Event()
+        self.missed_requests = [] # (endpoint, data) that missed the successor, sent on after its check
+        self.missed_lock = threading.Lock()
+        self.failure_stats = {"heartbeat_failures": 0, "failovers": 0, "timeouts": 0, "expired": 0, "late_responses": 0}
 
     @staticmethod
     def hash_id(value):
-        return int.from_bytes( hashlib.sha1(value.encode()).digest(), byteorder="little")
+        return storage.hash_id(value)
 
     @staticmethod
     def lies_in_range(start, end, key_hash):
@@ -94,10 +286,156 @@ class ChordNode:
     def is_responsible(self, key_hash):
         return self.lies_in_range(self.keys_start, self.keys_end, key_hash)
 
+    def owner_hint(self, initial_url, via_cache):
+        # range of this (responsible) node, returned to the initial node along with the response.
+        # not needed if the request started here or was already sent through the location cache.
+        if initial_url == self.url or via_cache:
+            return None
+        return [self.keys_start, self.keys_end, self.url]
+
+    @staticmethod
+    def resp_message(uid, response, owner=None):
+        return {"uid": uid, "response": response, **({"owner": owner} if owner is not None else {})}
+
+    def next_hop(self, key_hash, initial_url, via_cache):
+        # The node where an operation starts sends it straight to the node it learned serves the key.
+        # A request sent through the cache is only routed with the finger table afterwards, so a stale
+        # entry costs extra hops but never a loop. returns (next node, via_cache).
+        if initial_url == self.url and not via_cache:
+            url = self.location_cache.lookup(key_hash)
+            if url is not None and url != self.url:
+                return url, True
+        return self.finger_lookup(key_hash), via_cache
+
+    def handed_over(self, endpoint, data):
+        # operations that still reach us after we departed go on to the node that took over our keys
+        if self.departed_to is None:
+            return False
+        send_request(self.departed_to, endpoint, data)
+        return True
+
     def forward_request(self, endpoint, data, nonblocking=True):
         print(f"Forwarding {endpoint} request to the next node.")
         return send_request(self.successor_url, endpoint, data, nonblocking=nonblocking)
 
+    def send_routed(self, url, endpoint, data):
+        # request sent through a finger, the location cache or to the successor. If that node is gone, the
+        # finger is dropped and the request goes on through the successor (after failing over, if it was the successor).
+        return send_request(url, endpoint, data, on_miss=lambda: self.routing_miss(url, endpoint, data))
+
+    def routing_miss(self, url, endpoint, data):
+        self.finger_stats["misses"] += 1
+        self.mark_stale(url)
+        if url == self.successor_url:
+            # the heartbeat thread checks the successor (failing over if it is dead), then sends the request on
+            with self.missed_lock:
+                self.missed_requests.append((endpoint, data))
+            self.successor_suspect.set()
+            return
+        send_request(self.successor_url, endpoint, data)
+
+    def resend_missed(self):
+        with self.missed_lock:
+            missed, self.missed_requests = self.missed_requests, []
+        if self.successor_url is None:
+            return
+        for endpoint, data in missed:
+            send_request(self.successor_url, endpoint, data)
+
+    def start_stream_server(self):
+        self.stream_server = StreamServer(self.stream_addr, self.handle_stream_message, allow_peer=self.is_ring_peer)
+        self.stream_server.start()
+
+    def is_ring_peer(self, ip):
+        # frames only come from this machine or the hosts of the ring's nodes (the predecessor, in practice). The hosts are
+        # resolved again when an unknown address connects, at most once per heartbeat interval.
+        if ip in self.peer_ips:
+            return True
+        if time.monotonic() - self.peer_ips_refreshed < HEARTBEAT_INTERVAL:
+            return False
+        self.peer_ips_refreshed = time.monotonic()
+        hosts = {self.stream_addr.rsplit(":", 1)[0]}
+        for url in [self.predecessor_url, *self.membership.live_urls()]:
+            if url is not None:
+                hosts.add(urllib.parse.urlsplit(url).hostname)
+        peer_ips = {"127.0.0.1"}
+        for host in hosts:
+            try:
+                peer_ips.update(info[4][0] for info in socket.getaddrinfo(host, None, socket.AF_INET))
+            except OSError:
+                pass
+        self.peer_ips = peer_ips
+        return ip in peer_ips
+
+    def handle_stream_message(self, endpoint, data):
+        match endpoint:
+            case "replicateModify":
+                self.replicate_modify(**data)
+            case "replicateModifyBatch":
+                self.replicate_modify_batch(**data)
+            case "replicateQuery":
+                self.replicate_query(**data)
+
+    def successor_stream(self):
+        # None: replicate over HTTP. Called with chain_lock held, so it never blocks for long and never raises.
+        successor_url = self.successor_url
+        stream = self.succ_stream
+        if stream is not None and stream.url == successor_url:
+            return stream
+        no_stream_url, until = self.no_stream
+        if no_stream_url == successor_url and (until is None or time.monotonic() < until):
+            return None
+
+        try:
+            addr = session_pool.post(f"{successor_url}/streamAddr", json={}, timeout=HEARTBEAT_TIMEOUT).json()["response"]
+        except Exception:
+            # unreachable: the heartbeat deals with it. the stream is tried again later.
+            self.no_stream = (successor_url, time.monotonic() + HEARTBEAT_INTERVAL)
+            return None
+        if addr is None:
+            self.no_stream = (successor_url, None) # successor has no stream endpoint. Fall back to HTTP.
+            return None
+
+        with self.replicate_wakeup_lock:
+            if self.successor_url != successor_url:
+                return None
+            if self.succ_stream is not None and self.succ_stream.url == successor_url:
+                return self.succ_stream
+            old_stream = self.succ_stream
+            self.succ_stream = StreamSender(successor_url, addr, on_failure=self.stream_failed)
+            stream = self.succ_stream
+        if old_stream is not None:
+            old_stream.close()
+        return stream
+
+    def stream_failed(self, stream, frames):
+        # the successor could not be reached over the stream. The frames keep their sequence numbers
+        # and go over HTTP; the successor's reorder buffer puts them back in order.
+        with self.replicate_wakeup_lock:
+            if self.succ_stream is stream:
+                self.succ_stream = None
+                self.no_stream = (stream.url, time.monotonic() + HEARTBEAT_INTERVAL) # not reconnected right away
+            if stream.url != self.successor_url:
+                return # successor changed meanwhile, the frames were for the old chain
+        for endpoint, data in frames:
+            self.forward_request(endpoint, data)
+
+    def replicate_to_succ(self, endpoint, data):
+        if self.transport == "STREAM":
+            stream = self.successor_stream()
+            if stream is not None:
+                # the sequence number is assigned and the frame queued under the same lock,
+                # so the stream carries frames in sequence order.
+                with self.replicate_wakeup_lock:
+                    if stream is self.succ_stream and stream.submit(endpoint, {**data, "seq": self.seq_to_succ}):
+                        self.seq_to_succ += 1
+                        return
+
+        with self.replicate_wakeup_lock:
+            seq_send = self.seq_to_succ
+            self.seq_to_succ += 1
+        self.forward_request(endpoint, {**data, "seq": seq_send})
+
     def propagate_update_finger_table_phase1(self, initial_url, nodes):
         if initial_url == self.url:
             self.propagate_update_finger_table_phase2(None, nodes)
@@ -118,38 +456,284 @@ class ChordNode:
                 initial_url = self.url
             self.forward_request("updateFingerTablePhase2", {"initial_url": initial_url, "nodes": nodes}, nonblocking=False)
 
+    def ring_distance(self, key_hash):
+        # clockwise distance from this node
+        return (key_hash - self.node_id) % (2**160)
+
     def update_finger_table(self, nodes):
-        nodes = sorted(nodes, key=self.hash_id)
-
-        # circular rotation so that first node is the successor
-        succ_idx = nodes.index(self.successor_url)
-        nodes = nodes[succ_idx:] + nodes[:succ_idx]
-        print(nodes)
-        new_finger_table = []
-        for i in range(160):
-            start = (self.node_id + 2**i) % (2**160)
-            for node in nodes:
-                if self.lies_in_range(self.node_id, self.hash_id(node), start):
-                    # first(/nearest) node that may include keys>=start.
-                    new_finger_table.append(node)
+        # full rebuild from the list of all nodes (updateFingerTable walk).
+        # every node is hashed once, then each finger is a bisect over the sorted distances.
+        ring = sorted((self.ring_distance(self.node_id_of(node)), node) for node in set(nodes) if node != self.url)
+        ring_dists = [dist for dist, _ in ring]
+
+        with self.fingers_lock:
+            for i in range(160):
+                # first(/nearest) node that may include keys>=start.
+                idx = bisect.bisect_left(ring_dists, 2**i)
+                self.fingers[i] = ring[idx][1] if idx < len(ring) else self.url # wraps around to this node
+            self.index_fingers()
+        self.location_cache.invalidate()
+
+    def node_id_of(self, url):
+        node_id = self.node_ids.get(url, None)
+        if node_id is None:
+            node_id = self.node_ids[url] = self.hash_id(url)
+        return node_id
+
+    def index_fingers(self):
+        # caller holds self.fingers_lock. the distinct fingers are only sorted: their ids are cached.
+        ring = sorted((self.ring_distance(self.node_id_of(node)) if node != self.url else 2**160, node)
+                      for node in set(self.fingers) if node is not None)
+        self.finger_table = [((self.node_id + dist) % (2**160), node) for dist, node in ring]
+        self.finger_dists = [dist for dist, _ in ring]
+
+    def mark_stale(self, url):
+        with self.fingers_lock:
+            self.fingers = [None if node == url else node for node in self.fingers]
+            self.index_fingers()
+        self.location_cache.invalidate()
+
+    def find_successor(self, key_hash):
+        # url of the node responsible for key_hash: O(log N) hops through the fingers
+        if self.is_responsible(key_hash):
+            return self.url
+        if self.lies_in_range(self.node_id, self.successor_id, key_hash):
+            return self.successor_url
+        next_node = self.finger_lookup(key_hash)
+        try:
+            return request_response(next_node, "findSuccessor", {"key_hash": key_hash})
+        except Exception:
+            if next_node == self.successor_url:
+                raise
+            self.mark_stale(next_node)
+            return request_response(self.successor_url, "findSuccessor", {"key_hash": key_hash})
+
+    def fix_fingers(self):
+        # Chord's fix_fingers: a few fingers per round, stale (unknown) ones first, then round robin.
+        # A lookup also fills the following fingers that fall before the node it found.
+        while not self.departed:
+            time.sleep(FIX_FINGERS_INTERVAL)
+            if self.successor_url is None:
+                continue
+            try:
+                for _ in range(FIX_FINGERS_PER_ROUND):
+                    self.fix_finger(self.next_stale_finger())
+            except Exception:
+                traceback.print_exc()
+
+    def next_stale_finger(self):
+        with self.fingers_lock:
+            if None in self.fingers:
+                return self.fingers.index(None)
+            i = self.next_finger
+            self.next_finger = (i + 1) % 160
+            return i
+
+    def fix_finger(self, i):
+        if 2**i <= self.ring_distance(self.successor_id) or self.successor_url == self.url:
+            node = self.successor_url # no lookup needed
+        else:
+            node = self.find_successor((self.node_id + 2**i) % (2**160))
+            self.finger_stats["lookups"] += 1
+        dist = self.ring_distance(self.hash_id(node)) if node != self.url else 2**160
+        changed = False
+        with self.fingers_lock:
+            j = i
+            while j < 160 and (j == i or 2**j <= dist):
+                changed = changed or self.fingers[j] not in (None, node)
+                self.fingers[j] = node
+                j += 1
+            self.index_fingers()
+        if changed:
+            # another node joined or left: ranges learned before may be stale
+            self.finger_stats["changed"] += 1
+            self.location_cache.invalidate()
+
+    def start_fix_fingers(self):
+        threading.Thread(target=self.fix_fingers, daemon=True).start()
+
+    def gossip(self):
+        while not self.departed:
+            time.sleep(GOSSIP_INTERVAL)
+            if self.successor_url is None:
+                continue
+            self.membership.update_self(self.overlay_node())
+            peers = self.membership.peers(GOSSIP_FANOUT)
+            if not peers and self.successor_url != self.url:
+                peers = [self.successor_url] # nobody known yet
+            for peer in peers:
+                self.gossip_with(peer)
+
+    def gossip_with(self, peer):
+        # push-pull: the peer merges our table and answers with its own
+        try:
+            self.merge_members(request_response(peer, "gossip", {"members": self.membership.snapshot()}))
+        except Exception as e:
+            print(f"Gossip with {peer} failed:", e, flush=True)
+
+    def merge_members(self, members):
+        if self.membership.merge(members):
+            # a node joined or left: rebuild the fingers from the view, without walking the ring
+            # (fix_fingers corrects what the view does not know yet)
+            self.update_finger_table(self.membership.live_urls())
+
+    def start_gossip(self, seed_urls):
+        self.membership.update_self(self.overlay_node())
+        for seed_url in seed_urls:
+            if seed_url != self.url:
+                self.gossip_with(seed_url)
+        threading.Thread(target=self.gossip, daemon=True).start()
+
+    def probe(self, url):
+        # successor list of url, or None if it does not answer in time (or its manager answers for it)
+        try:
+            return session_pool.post(f"{url}/successorList", json={}, timeout=HEARTBEAT_TIMEOUT).json()["response"]
+        except Exception:
+            return None
+
+    def confirm_dead(self, url):
+        # HEARTBEAT_FAILURES probes in a row, so that a slow node is not taken for a dead one
+        for attempt in range(HEARTBEAT_FAILURES):
+            if self.probe(url) is not None:
+                return False
+            if attempt < HEARTBEAT_FAILURES-1:
+                time.sleep(HEARTBEAT_INTERVAL)
+        return True
+
+    def heartbeat(self):
+        # keeps the successor list (our successor, then its list) and detects a dead successor
+        failures = 0
+        while not self.departed:
+            suspected = self.successor_suspect.wait(HEARTBEAT_INTERVAL)
+            self.successor_suspect.clear()
+            with self.incoming_transfers_lock:
+                self.expire_transfers()
+            successor_url = self.successor_url
+            if successor_url is None or successor_url == self.url:
+                failures = 0
+                self.resend_missed()
+                continue
+            if suspected:
+                # a request to the successor missed: check it now instead of waiting for the probes to fail
+                if self.confirm_dead(successor_url):
+                    failures = 0
+                    try:
+                        self.failover(successor_url)
+                    except Exception:
+                        traceback.print_exc()
+                self.resend_missed()
+                continue
+            successors = self.probe(successor_url)
+            if successors is not None:
+                failures = 0
+                successor_list = [successor_url]
+                for url in successors:
+                    if url == self.url or len(successor_list) >= SUCCESSOR_LIST_SIZE:
+                        break # wrapped around the ring
+                    successor_list.append(url)
+                if self.successor_url == successor_url:
+                    self.successor_list = successor_list
+                continue
+            failures += 1
+            self.failure_stats["heartbeat_failures"] += 1
+            if failures >= HEARTBEAT_FAILURES:
+                failures = 0
+                try:
+                    self.failover(successor_url)
+                except Exception:
+                    traceback.print_exc()
+                self.resend_missed()
+
+    def checkpoint(self):
+        # The logs are paired with the positions they had one round earlier, so that what was written
+        # before them has reached the successor by the time its marker is taken (what was written after
+        # is sent again on rejoin, see storage.load_snapshot). A change of layout skips a round.
+        previous = None
+        while not self.departed:
+            time.sleep(CHECKPOINT_INTERVAL)
+            successor_url, replicas = self.successor_url, self.data_store
+            if successor_url is None or successor_url == self.url or replicas is None:
+                previous = None
+                continue
+            replicas = list(replicas)
+            try:
+                current = storage.log_positions(replicas)
+                if previous is not None and [path for path, _ in previous] == [path for path, _ in current]:
+                    marker = request_response(successor_url, "changeMarker", {})
+                    with self.checkpoint_lock:
+                        if not self.departed:
+                            storage.save_snapshot(replicas, marker, [position for _, position in previous])
+                previous = current
+            except Exception:
+                traceback.print_exc()
+                previous = None
+
+    def start_checkpoints(self):
+        if storage.STORAGE_BACKEND == "log":
+            threading.Thread(target=self.checkpoint, daemon=True).start()
+
+    def start_heartbeat(self):
+        threading.Thread(target=self.heartbeat, daemon=True).start()
+
+    def failover(self, failed_url):
+        # Our successor crashed. The first live node of the successor list takes over the keys of the dead
+        # node(s) before it, one at a time, from its replicas of them (as if they had departed), and we link to it.
+        with self.failover_lock:
+            if self.successor_url != failed_url:
+                return # already failed over
+            lock_id = self.acquire_arc_lock(lambda: None) # the arc cannot be walked through a dead node
+            dead, candidate = [failed_url], self.url
+            for url in self.successor_list[1:]:
+                if not self.confirm_dead(url):
+                    candidate = url
                     break
-            else:
-                assert False
-        self.finger_table = new_finger_table
+                dead.append(url)
+            print(f"Successor {failed_url} failed. Failing over to {candidate}.", flush=True)
+
+            self.update_succ_info(candidate)
+            for j in reversed(range(len(dead))):
+                # the farthest replica a dead node held is one unit of distance closer to us for each node before it
+                idx = self.replication_factor - 2 - j
+                items = self.data_store[idx].items() if idx >= 0 else []
+                send_request(candidate, "predFailed", {
+                    "failed_url": dead[j],
+                    "predecessor_url": dead[j-1] if j > 0 else self.url,
+                    "maxdistance_replica": send_replicas(candidate, [items])
+                    }, nonblocking=False)
+            self.failure_stats["failovers"] += 1
+            self.release_arc_lock(lock_id)
+
+    def pred_failed(self, failed_url, predecessor_url, maxdistance_replica):
+        if self.predecessor_url != failed_url:
+            return "Not our predecessor"
+        keys_start = self.hash_id(predecessor_url) + 1
+        if self.replication_factor == 1:
+            # no replica of its keys: they are lost
+            self.keys_start      = keys_start
+            self.predecessor_url = predecessor_url
+            self.location_cache.invalidate()
+            with self.replicate_wakeup_lock:
+                self.reset_seq_from_prev()
+            return "Took over the range of the failed predecessor"
+        self.depart_pred(keys_start, predecessor_url, maxdistance_replica)
+        return "Took over the keys of the failed predecessor"
 
     def finger_lookup(self, key_hash):
-        if self.lies_in_range(self.node_id, self.hash_id(self.successor_url), key_hash):
+        if self.lies_in_range(self.node_id, self.successor_id, key_hash):
+            return self.successor_url
+        if not self.finger_table:
             return self.successor_url
-        # forward to the nearest node that is strictly before the responsible node.
+        # forward to the nearest finger that is strictly before the responsible node, i.e. the one
+        # before the first finger at or past the key.
         # the check for the successor is necessary as it is the actual responsible node, and not
         # a node before it.
-        for finger_prev, finger in zip(self.finger_table, self.finger_table[1:]):
-            if self.lies_in_range(self.node_id, self.hash_id(finger), key_hash):
-                return finger_prev
-        return self.finger_table[-1]
+        idx = bisect.bisect_left(self.finger_dists, self.ring_distance(key_hash))
+        if idx >= len(self.finger_table):
+            return self.finger_table[-1][1]
+        return self.finger_table[max(idx, 1) - 1][1]
 
     @with_kwargs
-    def replicate_modify(self, seq, uid, initial_url, operation, key, value, distance, _kwargs=None):
+    def replicate_modify(self, seq, uid, initial_url, operation, key, value, distance, owner=None, version=None, _kwargs=None):
         # chain replication
         # This function is called for "insert" operations.
         # It applies the change, then forwards the request if necessary, then returns.
@@ -163,103 +747,292 @@ class ChordNode:
         # Seq=None is given by the initial caller (call that doesnt come from the network)
 
         if seq is not None:
-            with self.replicate_wakeup_lock:
-                if seq != self.seq_from_prev:
-                    self.reorder_buffer_replication[seq] = ("modify", _kwargs)
-                    return
-                else:
-                    self.seq_from_prev += 1
+            return self.replicate_in_order(seq, "modify", _kwargs)
+
+        if version is None and self.consistency_model != "EVENTUAL":
+            version = self.next_version() # chain head
 
+        with self.chain_lock:
+            self.apply_modify(operation, key, value, distance, version)
+            if distance < self.replication_factor-1:
+                self.replicate_to_succ("replicateModify", {**_kwargs, "distance": distance+1, "version": version})
+
+        if distance >= self.replication_factor-1:
+            if self.consistency_model != "EVENTUAL":
+                send_request(initial_url, "operation_resp", self.resp_message(uid, "ok modify", owner))
+                if distance > 0:
+                    self.commit_batcher.submit([key, version])
+
+    def next_version(self):
+        # versions of a key increase along its writes, also across a change of chain head (up to clock skew,
+        # which only makes a key look dirty for longer).
+        with self.dirty_lock:
+            self.version = max(self.version + 1, time.time_ns())
+            return self.version
+
+    def apply_modify(self, operation, key, value, distance, version=None):
+        # caller holds self.chain_lock
+        self.read_flights.pop(key, None)
+        self.change_log.record(key)
+        if version is not None and distance < self.replication_factor-1:
+            with self.dirty_lock:
+                self.dirty[key] = max(version, self.dirty.get(key, 0))
         match operation:
             case "insert":
-                if key in self.data_store[distance]:
-                    self.data_store[distance][key] += value
-                else:
-                    self.data_store[distance][key] = value
+                self.data_store[distance].append(key, value) # concatenates, without copying the current value
             case "delete":
                 self.data_store[distance].pop(key, None)
 
+    def flush_write_batch(self, ops):
+        if self.consistency_model != "EVENTUAL":
+            ops = [{**op, "version": self.next_version()} for op in ops]
+        self.replicate_modify_batch(None, ops, 0)
+
+    def flush_commits(self, commits):
+        self.commit_modify(commits, self.replication_factor-1)
+
+    def commit_modify(self, commits, distance):
+        # commits: [key, version] committed at the tail. Each replica up the chain marks them clean.
         if distance < self.replication_factor-1:
-            with self.replicate_wakeup_lock:
-                seq_send = self.seq_to_succ
-                self.seq_to_succ += 1
-            self.forward_request("replicateModify", {**_kwargs, "seq": seq_send, "distance": distance+1})
-        else:
-            if self.consistency_model != "EVENTUAL":
-                send_request(initial_url, "operation_resp", {"uid": uid, "response": "ok modify"})
+            with self.dirty_lock:
+                for key, version in commits:
+                    if self.dirty.get(key, version+1) <= version:
+                        del self.dirty[key]
+        if distance > 0:
+            send_request(self.predecessor_url, "commitModify", {"commits": commits, "distance": distance-1})
 
-        self.replicate_wakeup()
+    def is_clean(self, key):
+        return key not in self.dirty
 
+    @with_kwargs
+    def replicate_modify_batch(self, seq, ops, distance, _kwargs=None):
+        # Same as replicate_modify, for a batch of writes coalesced at the chain head.
+        # ops: list of {"uid", "initial_url", "operation", "key", "value"}, applied in order.
+        # The whole batch travels down the chain as one message, and it is acknowledged
+        # with one operation_resp_batch per originating node.
+        if seq is not None:
+            return self.replicate_in_order(seq, "modify_batch", _kwargs)
+
+        with self.chain_lock:
+            for op in ops:
+                self.apply_modify(op["operation"], op["key"], op["value"], distance, op.get("version", None))
+            if distance < self.replication_factor-1:
+                self.replicate_to_succ("replicateModifyBatch", {**_kwargs, "distance": distance+1})
+
+        # EVENTUAL: acknowledged once applied at the head. LINEARIZABLE: once applied at the tail.
+        if (self.consistency_model == "EVENTUAL" and distance == 0) or \
+                (self.consistency_model != "EVENTUAL" and distance == self.replication_factor-1):
+            responses = dict()
+            for op in ops:
+                responses.setdefault(op["initial_url"], []).append(self.resp_message(op["uid"], "ok modify", op.get("owner", None)))
+            for initial_url, initial_responses in responses.items():
+                send_request(initial_url, "operation_resp_batch", {"responses": initial_responses})
+            if self.consistency_model != "EVENTUAL" and distance > 0:
+                self.commit_modify([[op["key"], op["version"]] for op in ops], distance)
 
     @with_kwargs
-    def replicate_query(self, seq, uid, initial_url, key, distance, _kwargs=None):
+    def replicate_query(self, seq, uid, initial_url, key, distance, owner=None, flight=False, _kwargs=None):
         if seq is not None:
-            with self.replicate_wakeup_lock:
-                if seq != self.seq_from_prev:
-                    self.reorder_buffer_replication[seq] = ("query", _kwargs)
+            return self.replicate_in_order(seq, "query", _kwargs)
+
+        # CRAQ: the read goes on down the chain only while the key is dirty. The tail is always clean.
+        if distance < self.replication_factor-1 and not self.is_clean(key):
+            self.craq_stats["chain_reads"] += 1
+            if flight:
+                # already the shared read of an upstream replica
+                return self.replicate_to_succ("replicateQuery", {**_kwargs, "distance": distance+1})
+            with self.chain_lock:
+                self.expire_read_flights()
+                flight_uid = self.read_flights.get(key, None)
+                if flight_uid is not None:
+                    self.pending_requests[flight_uid]["waiters"].append((uid, initial_url, owner))
+                    self.flight_stats["coalesced"] += 1
                     return
-                else:
-                    self.seq_from_prev += 1
-
-        if distance < self.replication_factor-1:
-            with self.replicate_wakeup_lock:
-                seq_send = self.seq_to_succ
-                self.seq_to_succ += 1
-            self.forward_request("replicateQuery", {**_kwargs, "seq": seq_send, "distance": distance+1})
+                # the chain read reports back here, and its result goes to every waiter
+                flight_uid = uuid.uuid4().hex
+                self.pending_requests[flight_uid] = {"key": key, "waiters": [(uid, initial_url, owner)]}
+                self.read_flights[key] = flight_uid
+                self.flight_deadlines[flight_uid] = time.monotonic() + OPERATION_TIMEOUT
+                self.flight_stats["chain_reads"] += 1
+                self.replicate_to_succ("replicateQuery", {**_kwargs, "uid": flight_uid, "initial_url": self.url,
+                    "owner": None, "flight": True, "distance": distance+1})
         else:
-            res = self.data_store[-1].get(key, None)
+            self.craq_stats["clean_reads"] += 1
+            replica = self.data_store[distance] if distance < self.replication_factor-1 else self.data_store[-1]
+            res = replica.get(key, None)
             # Inform initial node of result
-            send_request(initial_url, "operation_resp", {"uid": uid, "response": res})
+            send_request(initial_url, "operation_resp", self.resp_message(uid, res, owner))
+
+    def expire_read_flights(self):
+        # caller holds self.chain_lock
+        now = time.monotonic()
+        while len(self.flight_deadlines) > 0:
+            flight_uid, deadline = next(iter(self.flight_deadlines.items()))
+            if deadline > now:
+                break
+            del self.flight_deadlines[flight_uid]
+            flight = self.pending_requests.pop(flight_uid, None)
+            if flight is not None and self.read_flights.get(flight["key"], None) == flight_uid:
+                del self.read_flights[flight["key"]]
+            self.flight_stats["expired"] += 1
+
+    def clear_flights(self):
+        # the successor changed (join, departure or failover). Reads already sent to the old one may still
+        # land (or expire), but the ones that follow start new flights through the new successor.
+        with self.chain_lock:
+            self.read_flights.clear()
+        with self.flights_lock:
+            self.entry_flights.clear()
+
+    def reset_seq_from_prev(self):
+        # caller holds self.replicate_wakeup_lock. a new predecessor numbers its messages from 0:
+        # whatever the old one left buffered is dropped.
+        self.seq_from_prev = 0
+        self.reorder_stats["dropped"] += len(self.reorder_buffer_replication)
+        self.reorder_buffer_replication = []
 
+    def replicate_in_order(self, seq, op, kwargs):
+        with self.replicate_wakeup_lock:
+            self.reorder_stats["messages"] += 1
+            if seq < self.seq_from_prev:
+                self.reorder_stats["dropped"] += 1 # duplicate (or from before a reset)
+                return
+            self.reorder_arrivals += 1
+            heapq.heappush(self.reorder_buffer_replication, (seq, self.reorder_arrivals, time.monotonic(), op, kwargs))
+            if seq != self.seq_from_prev:
+                self.reorder_stats["reordered"] += 1
+            self.reorder_stats["max_depth"] = max(self.reorder_stats["max_depth"], len(self.reorder_buffer_replication))
+            if self.replicate_draining:
+                return # the running drainer will pick it up
+            self.replicate_draining = True
         self.replicate_wakeup()
 
     def replicate_wakeup(self):
-        seq_wakeup = None
-        with self.replicate_wakeup_lock:
-            if min(self.reorder_buffer_replication.keys(), default=None) == self.seq_from_prev:
-                seq_wakeup = min(self.reorder_buffer_replication.keys())
-                (op, kwargs) = self.reorder_buffer_replication[seq_wakeup]
-                del self.reorder_buffer_replication[seq_wakeup]
-
-        if seq_wakeup is not None:
-            match op:
-                case "modify":
-                    self.replicate_modify(**kwargs)
-                case "query":
-                    self.replicate_query(**kwargs)
+        # Process every buffered message whose turn has come, in sequence order, in a loop
+        # (not through recursion). Only the caller that set replicate_draining gets here.
+        while True:
+            with self.replicate_wakeup_lock:
+                buffer = self.reorder_buffer_replication
+                while len(buffer) > 0 and buffer[0][0] < self.seq_from_prev:
+                    heapq.heappop(buffer) # duplicate of a message already applied
+                    self.reorder_stats["dropped"] += 1
+                if len(buffer) == 0 or buffer[0][0] != self.seq_from_prev:
+                    self.replicate_draining = False
+                    return
+                _, _, buffered_at, op, kwargs = heapq.heappop(buffer)
+                self.seq_from_prev += 1
+
+                wait = time.monotonic() - buffered_at
+                self.reorder_stats["total_wait"] += wait
+                self.reorder_stats["max_wait"] = max(self.reorder_stats["max_wait"], wait)
+
+            kwargs = {**kwargs, "seq": None}
+            try:
+                match op:
+                    case "modify":
+                        self.replicate_modify(**kwargs)
+                    case "modify_batch":
+                        self.replicate_modify_batch(**kwargs)
+                    case "query":
+                        self.replicate_query(**kwargs)
+            except Exception:
+                traceback.print_exc()
 
     @with_kwargs
-    def modify(self, uid, initial_url, operation, key, value, _kwargs=None):
+    def modify(self, uid, initial_url, operation, key, value, via_cache=False, deadline=None, _kwargs=None):
+        if self.expired(deadline) or self.handed_over("modify", _kwargs):
+            return
         key_hash = self.hash_id(key)
         if self.is_responsible(key_hash):
+            owner = self.owner_hint(initial_url, via_cache)
+            if self.write_batcher.max_size > 1:
+                self.write_batcher.submit({"uid": uid, "initial_url": initial_url, "operation": operation,
+                    "key": key, "value": value, **({"owner": owner} if owner is not None else {})})
+                return
             if self.consistency_model == "EVENTUAL":
-                send_request(initial_url, "operation_resp", {"uid": uid, "response": "ok modify"})
-            self.replicate_modify(None, uid, initial_url, operation, key, value, 0)
+                send_request(initial_url, "operation_resp", self.resp_message(uid, "ok modify", owner))
+                owner = None
+            self.replicate_modify(None, uid, initial_url, operation, key, value, 0, owner)
         else:
-            next_node = self.finger_lookup(key_hash)
-            return send_request(next_node, "modify", _kwargs)
+            next_node, via_cache = self.next_hop(key_hash, initial_url, via_cache)
+            return self.send_routed(next_node, "modify", {**_kwargs, "via_cache": via_cache})
 
     @with_kwargs
-    def query(self, uid, initial_url, key, _kwargs=None):
+    def query(self, uid, initial_url, key, via_cache=False, deadline=None, _kwargs=None):
         # We assume that key != "*" here
+        if self.expired(deadline) or self.handed_over("query", _kwargs):
+            return
+        key_hash = self.hash_id(key)
         if self.consistency_model == "EVENTUAL":
-            if self.is_responsible(self.hash_id(key)):
+            if self.is_responsible(key_hash):
                 res = self.data_store[0].get(key, None)
-                send_request(initial_url, "operation_resp", {"uid": uid, "response": res})
+                send_request(initial_url, "operation_resp", self.resp_message(uid, res, self.owner_hint(initial_url, via_cache)))
                 return
             for data_store_i in self.data_store[::-1]:
                 if key in data_store_i:
                     return send_request(initial_url, "operation_resp", {"uid": uid, "response": data_store_i[key]})
-            next_node = self.finger_lookup(self.hash_id(key))
-            return send_request(next_node, "query", _kwargs)
+            next_node, via_cache = self.next_hop(key_hash, initial_url, via_cache)
+            return self.send_routed(next_node, "query", {**_kwargs, "via_cache": via_cache})
         else:
-            # LINEARIZABLE
-            key_hash = self.hash_id(key)
+            # LINEARIZABLE (CRAQ): the read starts at the first replica of the key's chain it meets
+            # (at the head for missing keys) and is served there if the key is clean.
             if self.is_responsible(key_hash):
-                self.replicate_query(None, uid, initial_url, key, 0)
+                return self.replicate_query(None, uid, initial_url, key, 0, self.owner_hint(initial_url, via_cache))
+            for distance, data_store_i in enumerate(self.data_store):
+                if key in data_store_i:
+                    return self.replicate_query(None, uid, initial_url, key, distance)
+            next_node, via_cache = self.next_hop(key_hash, initial_url, via_cache)
+            return self.send_routed(next_node, "query", {**_kwargs, "via_cache": via_cache})
+
+    def expired(self, deadline):
+        # the initial node has given up on the operation (wall clock: assumes the clocks of the nodes are close)
+        if deadline is not None and time.time() > deadline:
+            self.failure_stats["expired"] += 1
+            return True
+        return False
+
+    def direct_query(self, key):
+        # query sent by a smart client straight to the node it believes serves the key:
+        # the head of the chain (EVENTUAL) or any replica of it (LINEARIZABLE). returns (response, misrouted).
+        if self.departed_to is not None:
+            return self.operation_driver(self.query, key), True
+        if self.consistency_model == "EVENTUAL":
+            if self.is_responsible(self.hash_id(key)):
+                return self.data_store[0].get(key, None), False
+            return self.operation_driver(self.query, key), True
+        if key in self.data_store[-1] or (self.is_clean(key) and any(key in data_store_i for data_store_i in self.data_store)):
+            # clean here (the tail always is): the local value is the committed one.
+            self.craq_stats["clean_reads"] += 1
+            return next(data_store_i[key] for data_store_i in self.data_store if key in data_store_i), False
+        # missing or dirty key: the chain read decides. The client's view is stale if we are
+        # neither the head of the key nor hold a replica of it (as for modifies).
+        misrouted = not self.is_responsible(self.hash_id(key)) and not any(key in data_store_i for data_store_i in self.data_store)
+        return self.operation_driver(self.query, key), misrouted
+
+    def batch(self, ops):
+        # ops: list of {"uid", "initial_url", "operation", "key"[, "value"]}, operation in insert/delete/query.
+        # Operations this node can serve run here. The rest are grouped by next hop (finger table)
+        # and sent as one sub-batch per destination, in parallel.
+        if self.handed_over("batch", {"ops": ops}):
+            return
+        groups = dict()
+        for op in ops:
+            if self.expired(op.get("deadline", None)):
+                continue
+            key_hash = self.hash_id(op["key"])
+            is_local = self.is_responsible(key_hash) or \
+                    (op["operation"] == "query" and any(op["key"] in data_store_i for data_store_i in self.data_store))
+            if is_local:
+                if op["operation"] == "query":
+                    self.query(op["uid"], op["initial_url"], op["key"], deadline=op.get("deadline", None))
+                else:
+                    self.modify(op["uid"], op["initial_url"], op["operation"], op["key"], op.get("value", None),
+                            deadline=op.get("deadline", None))
             else:
-                next_node = self.finger_lookup(key_hash)
-                return send_request(next_node, "query", _kwargs)
+                groups.setdefault(self.finger_lookup(key_hash), []).append(op)
+
+        for next_node, group in groups.items():
+            self.send_routed(next_node, "batch", {"ops": group})
 
     @with_kwargs
     def query_star(self, uid, initial_url, value=None, _kwargs=None):
@@ -268,25 +1041,101 @@ class ChordNode:
         else:
             if value is None:
                 value = {}
-            value = value | self.data_store[-1]
+            value = value | self.data_store[-1].to_dict()
             self.forward_request("query_star", {**_kwargs, "value":value})
 
-    def new_pred(self, new_node_url):
-        new_node_id = self.hash_id(new_node_url)
+    @staticmethod
+    def encode_cursor(start_url, node_url, after):
+        return base64.urlsafe_b64encode(json.dumps([start_url, node_url, after]).encode()).decode()
 
-        ret_dict = {}
-        for key, value in self.data_store[0].items():
-            if self.lies_in_range(self.keys_start, new_node_id, self.hash_id(key)):
-                ret_dict[key] = value
+    @staticmethod
+    def decode_cursor(cursor):
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+
+    def scan(self, cursor, page_size):
+        # One page of a full scan. The cursor is (node where the scan started, node to read next,
+        # last hash read from it). Every key lives in exactly one data_store[-1], so the scan walks
+        # the data_store[-1] of every node once, in ring order, one page per call.
+        if cursor is None:
+            start_url, node_url, after = self.url, self.url, None
+        else:
+            start_url, node_url, after = self.decode_cursor(cursor)
 
-        new_data_store = [None for _ in range(self.replication_factor)]
-        new_data_store[0] = ret_dict
-        new_data_store[1:] = self.data_store[1:]
+        if node_url == self.url:
+            page = self.scan_page(None, None, after, page_size)
+        else:
+            page = self.operation_driver(self.scan_page, after, page_size, node_url=node_url)
 
-        if self.replication_factor < self.max_replication_factor:
-            # increasing replication factor. preparing the appropriate for the new node.
-            # max distance backwards from new node is the current node.
-            new_data_store.append({k:v for k,v in self.data_store[0].items() if k not in ret_dict})
+        if page["more"]:
+            next_cursor = self.encode_cursor(start_url, node_url, page["last_hash"])
+        elif page["successor_url"] != start_url:
+            next_cursor = self.encode_cursor(start_url, page["successor_url"], None)
+        else:
+            next_cursor = None
+        return {"items": page["items"], "cursor": next_cursor}
+
+    def scan_page(self, uid, initial_url, after, page_size, node_url=None):
+        if node_url is not None and node_url != self.url:
+            return send_request(node_url, "scanPage", {"uid": uid, "initial_url": initial_url,
+                "after": after, "page_size": page_size})
+
+        entries = self.data_store[-1].page_after(after, page_size + 1)
+        page = {
+                "items": {key: value for _, key, value in entries[:page_size]},
+                "more": len(entries) > page_size,
+                "last_hash": entries[page_size-1][0] if len(entries) > page_size else None,
+                "successor_url": self.successor_url,
+                }
+        if uid is None:
+            return page
+        send_request(initial_url, "operation_resp", {"uid": uid, "response": page})
+
+    def rejoin_delta(self, new_node_id, snapshot):
+        # The changes since a rejoining node departed, if its snapshot still matches what it would receive:
+        # (upserts per replica of the new node, [keys deleted from its range, keys deleted from its other replicas]).
+        # None otherwise.
+        if snapshot is None or snapshot["replicas"] != self.replication_factor or \
+                self.replication_factor < self.max_replication_factor:
+            return None
+        changed = self.change_log.since(snapshot)
+        if changed is None:
+            return None
+        # keys the node wrote after its last checkpoint may not have reached us before it crashed
+        changed = list(dict.fromkeys(changed + snapshot.get("suspects", [])))
+        upserts = [[] for _ in range(self.replication_factor)]
+        deleted = [[], []]
+        for key in changed:
+            key_hash = self.hash_id(key)
+            if self.lies_in_range(self.keys_start, new_node_id, key_hash):
+                idx = 0
+            elif self.lies_in_range(new_node_id+1, self.keys_end, key_hash):
+                continue # stays ours
+            else:
+                idx = next((i for i in range(1, self.replication_factor) if key in self.data_store[i]), None)
+            value = self.data_store[idx].get(key, None) if idx is not None else None
+            if value is None:
+                deleted[0 if idx == 0 else 1].append(key)
+            else:
+                upserts[idx].append((key, value))
+        return upserts, deleted
+
+    def new_pred(self, new_node_url, snapshot=None):
+        new_node_id = self.hash_id(new_node_url)
+
+        delta = self.rejoin_delta(new_node_id, snapshot)
+        if delta is not None:
+            # rejoin: only what changed since the node departed
+            new_data_store, deleted = delta
+        else:
+            deleted = None
+            new_data_store = [None for _ in range(self.replication_factor)]
+            new_data_store[0] = self.data_store[0].range_items(self.keys_start, new_node_id)
+            new_data_store[1:] = [replica.items() for replica in self.data_store[1:]]
+
+            if self.replication_factor < self.max_replication_factor:
+                # increasing replication factor. preparing the appropriate for the new node.
+                # max distance backwards from new node is the current node.
+                new_data_store.append(self.data_store[0].outside_items(self.keys_start, new_node_id))
 
         send_request(new_node_url, "joinResponse", {
             "predecessor_url": self.predecessor_url,
@@ -296,7 +1145,9 @@ class ChordNode:
             "replication_factor": self.replication_factor if self.replication_factor==self.max_replication_factor else self.replication_factor+1,
             "max_replication_factor": self.max_replication_factor,
             "consistency_model": self.consistency_model,
-            "data_store": new_data_store}, nonblocking=False)
+            "transport": self.transport,
+            "data_store": send_replicas(new_node_url, new_data_store),
+            "deleted": deleted}, nonblocking=False)
 
         # inform my old predecessor to update his successor to new_node_url
         send_request(self.predecessor_url, "update_succ_info", {
@@ -308,27 +1159,50 @@ class ChordNode:
 
         self.predecessor_url = new_node_url
         with self.replicate_wakeup_lock:
-            self.seq_from_prev = 0
+            self.reset_seq_from_prev()
 
         if self.replication_factor < self.max_replication_factor:
             self.inc_replication_factor(new_node_url, 1, new_node_start, new_node_id)
             # it should stop at the new node. we have already given him the correct data.
         else:
             self.shift_up_replicas(0, self.keys_start, self.keys_end)
+        self.change_log.reset()
 
     def join_response(self, predecessor_url, successor_url, keys_start, keys_end,\
-            replication_factor, max_replication_factor, consistency_model, data_store):
+            replication_factor, max_replication_factor, consistency_model, transport, data_store, deleted=None):
         self.predecessor_url    = predecessor_url
         self.successor_url      = successor_url
+        self.successor_id       = self.hash_id(successor_url)
+        self.successor_list     = [successor_url]
         self.keys_start         = keys_start
         self.keys_end           = keys_end
         self.replication_factor = replication_factor
         self.max_replication_factor = max_replication_factor
         self.consistency_model = consistency_model
+        self.transport          = transport
+
+        if deleted is not None:
+            # delta against the snapshot of our previous departure
+            replicas = self.snapshot[1]
+            for key in deleted[0]:
+                replicas[0].pop(key, None)
+            for key in deleted[1]:
+                for replica in replicas[1:]:
+                    replica.pop(key, None)
+            for replica, delta_upserts in zip(replicas, data_store):
+                replica |= delta_upserts
+                delta_upserts.destroy()
+            data_store = replicas
+        elif self.snapshot is not None:
+            for replica in self.snapshot[1]:
+                replica.destroy() # full transfer: the snapshot is of no use
+        self.snapshot = None
         self.data_store         = data_store
+        self.change_log.reset()
 
         self.seq_to_succ   = 0
-        self.seq_from_prev = 0
+        with self.replicate_wakeup_lock:
+            self.reset_seq_from_prev()
 
 
 
@@ -338,27 +1212,27 @@ class ChordNode:
             return
         else:
             self.replication_factor += 1
-            self.data_store.append({})
+            self.change_log.reset()
+            self.data_store.append(Replica()) # placeholder, always overwritten below
             for i in range(distance+1, self.replication_factor)[::-1]:
                 self.data_store[i] = self.data_store[i-1] # distance increases
-            self.data_store[distance] = self.data_store[distance-1]
-            self.data_store[distance-1] = {k:v for k,v in self.data_store[distance].items() \
-                    if not self.lies_in_range(new_node_start, new_node_end, self.hash_id(k))}
-            self.data_store[distance] = {k:v for k,v in self.data_store[distance].items() \
-                    if self.lies_in_range(new_node_start, new_node_end, self.hash_id(k))}
+            # the keys of the new node move one unit of distance further
+            self.data_store[distance] = self.data_store[distance-1].extract_range(new_node_start, new_node_end)
 
             self.forward_request("incReplicationFactor", {**_kwargs, "distance": distance+1}, nonblocking=False)
 
     def shift_up_replicas(self, distance, exclude_start, exclude_end):
+        self.change_log.reset()
+        # the farthest replica falls off the end (or the moved keys, if there is no replica after distance)
+        dropped = self.data_store[-1]
         for i in range(distance+2, self.replication_factor)[::-1]:
             self.data_store[i] = self.data_store[i-1] # distance increased
+        moved = self.data_store[distance].extract_outside(exclude_start, exclude_end)
         if distance+1 < self.replication_factor:
-            self.data_store[distance+1] =\
-                    {k:v for k,v in self.data_store[distance].items() if\
-                    not self.lies_in_range(exclude_start, exclude_end, self.hash_id(k))}
-        self.data_store[distance] =\
-                {k:v for k,v in self.data_store[distance].items() if\
-                self.lies_in_range(exclude_start, exclude_end, self.hash_id(k))}
+            self.data_store[distance+1] = moved
+        else:
+            dropped = moved
+        dropped.destroy()
 
         if distance < self.replication_factor-1:
            self.forward_request("shiftUpReplicas", {
@@ -368,31 +1242,98 @@ class ChordNode:
                 }, nonblocking=False)
 
     @with_kwargs
-    def join_request(self, new_node_url, _kwargs=None):
+    def join_request(self, new_node_url, snapshot=None, _kwargs=None):
         new_node_id = self.hash_id(new_node_url)
 
         if self.is_responsible(new_node_id):
             print(f"Trying to insert {new_node_id}")
-            self.new_pred(new_node_url)
+            self.new_pred(new_node_url, snapshot)
 
         else:
-            data = {"new_node_url": new_node_url}
-            self.forward_request("join", _kwargs, nonblocking=False)
+            # straight to the node that will be the successor of the new node, found through the fingers
+            successor_url = self.find_successor(new_node_id)
+            send_request(successor_url, "join", _kwargs, nonblocking=False)
             return "Forwarded join_request request"
 
     def join_existing(self, bootstrap_url):
+        # returns whether we are part of the ring (joinResponse arrived)
         join_cmd = {"new_node_url": self.url}
+        self.snapshot = storage.load_snapshot()
+        if self.snapshot is not None:
+            marker, replicas = self.snapshot
+            join_cmd["snapshot"] = {**marker, "replicas": len(replicas)}
         try:
             send_request(bootstrap_url, "join", join_cmd, nonblocking=False)
-            self.propagate_update_finger_table_phase1(None, None)
         except Exception as e:
             print("Error joining chord ring:", e, flush=True)
+        return self.data_store is not None
+
+    def chain_arc(self, hops):
+        # arc of node ids that a join right before this node, or the departure of this node, touches:
+        # from the predecessor (its successor changes) to the hops-th successor (the replicas shift).
+        # None if that is the whole ring.
+        pred_id = self.hash_id(self.predecessor_url)
+        end_id  = self.chain_end([self.url, self.predecessor_url], hops)
+        if end_id is None or end_id == pred_id:
+            return None
+        return [pred_id, end_id]
+
+    def chain_end(self, stop_urls, hops):
+        if hops == 0:
+            return self.node_id
+        if self.successor_url in stop_urls:
+            return None # wrapped around the ring
+        return request_response(self.successor_url, "chainEnd", {"stop_urls": stop_urls, "hops": hops-1})
+
+    def join_arc(self, node_url):
+        # arc that the join of node_url touches (see chain_arc), for the locking service
+        successor_url = self.find_successor(self.hash_id(node_url))
+        return request_response(successor_url, "chainArc", {"hops": self.max_replication_factor})
+
+    def acquire_arc_lock(self, arc_of):
+        # the arc is computed again once the lock is granted: a membership change next to it may have moved it
+        while True:
+            arc = arc_of()
+            lock_id = session_pool.post(f"{self.locking_srv_url}/lock-acquire", json={"range": arc}).json()["lock_id"]
+            if arc_of() == arc:
+                break
+            send_request(self.locking_srv_url, "lock-release", {"lock_id": lock_id}, nonblocking=False)
+        stop = threading.Event()
+        self.lock_renewals[lock_id] = stop
+        threading.Thread(target=self.renew_lock, args=(lock_id, stop), daemon=True).start()
+        return lock_id
+
+    def renew_lock(self, lock_id, stop):
+        # a membership change can outlast the lease (large transfers), so the lease is kept alive while we hold the lock
+        while not stop.wait(LOCK_RENEW_INTERVAL):
+            try:
+                status = session_pool.post(f"{self.locking_srv_url}/lock-renew", json={"lock_id": lock_id}).json()["status"]
+            except Exception:
+                traceback.print_exc()
+                continue
+            if status != "ok":
+                print(f"Lock {lock_id} expired before it could be renewed.", flush=True)
+                return
+
+    def release_arc_lock(self, lock_id):
+        self.lock_renewals.pop(lock_id).set()
+        status = session_pool.post(f"{self.locking_srv_url}/lock-release", json={"lock_id": lock_id}).json()["status"]
+        if status != "ok":
+            # the lock was dropped while we held it: another membership change may have overlapped ours
+            raise RuntimeError(f"Lock {lock_id} expired before it was released.")
 
     def update_succ_info(self, new_node_url):
         new_node_id = self.hash_id(new_node_url)
         self.successor_url = new_node_url
+        self.successor_id  = self.hash_id(new_node_url)
+        self.successor_list = [new_node_url]
         with self.replicate_wakeup_lock:
             self.seq_to_succ = 0
+            old_stream, self.succ_stream = self.succ_stream, None
+        if old_stream is not None:
+            old_stream.close()
+        self.location_cache.invalidate()
+        self.clear_flights()
 
         return "Successfully updated succ info"
 
@@ -400,52 +1341,81 @@ class ChordNode:
         if self.departed: return
         self.departed = True
 
-        send_request(self.locking_srv_url, "lock-acquire", {}, nonblocking=False)
+        lock_id = self.acquire_arc_lock(lambda: self.chain_arc(self.max_replication_factor))
 
         print(f"Node {self.node_id} beginning to depart", flush=True)
 
-        # wait until reorder buffer empties
+        # wait until buffered writes are replicated and the reorder buffer empties
+        while self.write_batcher.pending() > 0 or self.commit_batcher.pending() > 0:
+            time.sleep(0.1)
         while True:
             with self.replicate_wakeup_lock:
                 if len(self.reorder_buffer_replication) == 0:
                     break
             time.sleep(0.1)
 
+        # from here on the successor logs the changes we would miss, in case we rejoin
+        marker = request_response(self.successor_url, "changeMarker", {})
+
         send_request(self.predecessor_url, "update_succ_info",
                 {"new_node_url": self.successor_url}, nonblocking=False)
 
         self.forward_request("departPred", {
             "keys_start": self.keys_start,
             "predecessor_url": self.predecessor_url,
-            "maxdistance_replica": self.data_store[-1]
+            "maxdistance_replica": send_replicas(self.successor_url, [self.data_store[-1].items()])
             }, nonblocking=False)
+        self.departed_to = self.successor_url
+
+        try:
+            with self.checkpoint_lock:
+                storage.save_snapshot(self.data_store, marker)
+        except OSError as e:
+            print("Could not save snapshot:", e, flush=True)
+
+        # the others learn that we left from gossip, instead of timing us out
+        self.membership.update_self(self.overlay_node(), status="left")
+        for peer in {self.successor_url, self.predecessor_url, *self.membership.peers(GOSSIP_FANOUT)}:
+            if peer != self.url:
+                self.gossip_with(peer)
 
         self.successor_url = None
         self.predecessor_url = None
+        if self.succ_stream is not None:
+            self.succ_stream.close()
 
-        send_request(self.locking_srv_url, "lock-release", {}, nonblocking=False)
+        try:
+            self.release_arc_lock(lock_id)
+        finally:
+            # flush outbound messages before exiting (dispatcher workers are daemons)
+            while dispatcher.pending() > 0 or (self.succ_stream is not None and self.succ_stream.pending() > 0):
+                time.sleep(0.1)
 
-        my_pid = os.getpid()
-        os.kill(my_pid, signal.SIGINT)
+            my_pid = os.getpid()
+            os.kill(my_pid, signal.SIGINT)
 
         return f"Node {self.node_id} is departing from the network."
 
     def depart_pred(self, keys_start, predecessor_url, maxdistance_replica):
         self.keys_start       = keys_start
         self.predecessor_url  = predecessor_url
+        self.location_cache.invalidate()
 
         with self.replicate_wakeup_lock:
-            self.seq_from_prev = 0
+            self.reset_seq_from_prev()
 
         self.data_store[1] |= self.data_store[0]  # shift_down_replicas will then move this one unit of distance downwards
 
-        self.propagate_update_finger_table_phase1(None, None)
         self.shift_down_replicas(None, 0, maxdistance_replica)
 
     def shift_down_replicas(self, initial_url, distance, maxdistance_replica):
         if initial_url == self.url:
             return self.dec_replication_factor(None)
+        if initial_url is not None:
+            # (not the departure of our predecessor, whose changes are logged for its rejoin)
+            self.change_log.reset()
 
+        dropped = self.data_store[distance] # shifted out (see depart_pred for the merge at distance 0)
         for i in range(distance, self.replication_factor-1):
             self.data_store[i] = self.data_store[i+1]
         old_maxdistance_replica = self.data_store[-1]
@@ -457,37 +1427,89 @@ class ChordNode:
             self.forward_request("shiftDownReplicas", {
                 "initial_url": initial_url,
                 "distance": distance+1,
-                "maxdistance_replica": old_maxdistance_replica
+                "maxdistance_replica": send_replicas(self.successor_url, [old_maxdistance_replica.items()])
                 }, nonblocking=False)
+        dropped.destroy()
 
     def dec_replication_factor(self, initial_url):
         if initial_url==self.url:
             return
         else:
             self.replication_factor -= 1
-            self.data_store.pop()
+            self.change_log.reset()
+            self.data_store.pop().destroy()
             if initial_url is None:
                 initial_url = self.url
             self.forward_request("decReplicationFactor", {"initial_url": initial_url}, nonblocking=False)
 
+    def overlay_node(self):
+        return {
+                "url": self.url,
+                "predecessor_url": self.predecessor_url,
+                "successor_url": self.successor_url,
+                "keys_start": str(self.keys_start),
+                "keys_end": str(self.keys_end),
+                "replication_factor": self.replication_factor,
+                "consistency_model": self.consistency_model,
+                }
+
+    def membership_overlay(self):
+        # overlay from the gossiped view, in ring order starting at this node. eventually consistent:
+        # a recent join or departure may not show yet (the ring walk below is exact).
+        nodes = [node for node in self.membership.live_states() if node["url"] != self.url] + [self.overlay_node()]
+        return sorted(nodes, key=lambda node: self.ring_distance(self.hash_id(node["url"])))
+
     @with_kwargs
     def overlay(self, uid, initial_url, nodes=None, _kwargs=None):
         if nodes is not None and self.url == initial_url:
             self.operation_resp(uid=uid, response=nodes)
         else:
-            node = {
-                    "url": self.url,
-                    "predecessor_url": self.predecessor_url,
-                    "successor_url": self.successor_url,
-                    "keys_start": str(self.keys_start),
-                    "keys_end": str(self.keys_end),
-                    }
+            node = self.overlay_node()
             if nodes is None:
                 nodes = [node]
             else:
                 nodes.append(node)
             self.forward_request("overlay", {**_kwargs, "nodes": nodes})
 
+    def receive_chunk(self, transfer_id, replica_idx, chunk_idx, body):
+        # Applies the chunk if it is the next expected one (duplicates of retried chunks are skipped).
+        # Returns the next expected chunk.
+        with self.incoming_transfers_lock:
+            self.expire_transfers()
+            replicas = self.incoming_transfers.setdefault(transfer_id, {})
+            self.transfer_deadlines.pop(transfer_id, None) # moved to the end
+            self.transfer_deadlines[transfer_id] = time.monotonic() + TRANSFER_IDLE_TIMEOUT
+            # transferred replicas are (mostly) the ones this node will serve from
+            state = replicas.setdefault(replica_idx, {"replica": Replica(durable=True), "next_chunk": 0})
+            if chunk_idx == state["next_chunk"]:
+                for key, value in transfer.decode_chunk(body):
+                    state["replica"][key] = value
+                state["next_chunk"] += 1
+            return state["next_chunk"]
+
+    def expire_transfers(self):
+        # caller holds self.incoming_transfers_lock. the sender died (or the join was aborted) mid-transfer.
+        now = time.monotonic()
+        while len(self.transfer_deadlines) > 0:
+            transfer_id, deadline = next(iter(self.transfer_deadlines.items()))
+            if deadline > now:
+                break
+            del self.transfer_deadlines[transfer_id]
+            print(f"Dropping abandoned transfer {transfer_id}.", flush=True)
+            for state in self.incoming_transfers.pop(transfer_id, {}).values():
+                state["replica"].destroy()
+
+    def claim_transfer(self, descriptor):
+        with self.incoming_transfers_lock:
+            self.transfer_deadlines.pop(descriptor["transfer_id"], None)
+            replicas = self.incoming_transfers.pop(descriptor["transfer_id"], {})
+        chunks = descriptor.get("chunks", None)
+        if chunks is not None and any(chunks[i] != (replicas[i]["next_chunk"] if i in replicas else 0) for i in range(len(chunks))):
+            for state in replicas.values():
+                state["replica"].destroy()
+            raise RuntimeError(f"Transfer {descriptor['transfer_id']} is incomplete (dropped while idle?).")
+        return [replicas[i]["replica"] if i in replicas else Replica(durable=True) for i in range(descriptor["replicas"])]
+
     def debug_print_keys(self):
         print("Printing Hash Table:", flush=True)
         for i, data_store_replica in enumerate(self.data_store):
@@ -498,45 +1520,188 @@ class ChordNode:
     def operation_driver(self, func, *args, **kwargs):
         uid = uuid.uuid4().hex
         event = threading.Event()
-        self.pending_requests[uid] = {"event": event}
+        # the epoch is recorded so that location hints of requests older than a membership change are dropped
+        self.pending_requests[uid] = {"event": event, "epoch": self.location_cache.epoch}
+        # operations that can be routed around the ring carry their deadline, so that nodes drop them once we gave up
+        deadline = time.time() + OPERATION_TIMEOUT
+        if "deadline" in inspect.signature(func).parameters:
+            kwargs["deadline"] = deadline
         func(uid, self.url, *args, **kwargs)
-        event.wait()
+        if not event.wait(timeout=OPERATION_TIMEOUT):
+            del self.pending_requests[uid]
+            self.failure_stats["timeouts"] += 1
+            raise TimeoutError("Operation timed out.")
         resp = self.pending_requests[uid]["response"]
         del self.pending_requests[uid]
         return resp
 
-    def operation_resp(self, uid, response):
-        assert uid in self.pending_requests
+    def batch_operation_driver(self, operations):
+        # operation_driver for many operations at once: results are returned in the same order.
+        ops = []
+        deadline = time.time() + OPERATION_TIMEOUT
+        for operation in operations:
+            uid = uuid.uuid4().hex
+            self.pending_requests[uid] = {"event": threading.Event()}
+            ops.append({**operation, "uid": uid, "initial_url": self.url, "deadline": deadline})
+        self.batch(ops)
+        responses = []
+        for op in ops:
+            if not self.pending_requests[op["uid"]]["event"].wait(timeout=max(0, deadline - time.time())):
+                for pending_op in ops:
+                    self.pending_requests.pop(pending_op["uid"], None)
+                self.failure_stats["timeouts"] += 1
+                raise TimeoutError("Operation timed out.")
+            responses.append(self.pending_requests.pop(op["uid"])["response"])
+        return responses
+
+    def land_read_flight(self, uid, response):
+        with self.chain_lock:
+            flight = self.pending_requests.pop(uid, None)
+            if flight is None:
+                self.failure_stats["late_responses"] += 1 # expired meanwhile
+                return
+            self.flight_deadlines.pop(uid, None)
+            if self.read_flights.get(flight["key"], None) == uid:
+                del self.read_flights[flight["key"]]
+        responses = dict()
+        for waiter_uid, initial_url, owner in flight["waiters"]:
+            responses.setdefault(initial_url, []).append(self.resp_message(waiter_uid, response, owner))
+        for initial_url, initial_responses in responses.items():
+            if len(initial_responses) == 1:
+                send_request(initial_url, "operation_resp", initial_responses[0])
+            else:
+                send_request(initial_url, "operation_resp_batch", {"responses": initial_responses})
+
+    def entry_query(self, key):
+        # EVENTUAL: identical queries entering at this node while one is in progress share its result.
+        # (the serving replica answers from memory, so this is the only place a read is in flight.)
+        if self.consistency_model != "EVENTUAL":
+            return self.operation_driver(self.query, key)
+        with self.flights_lock:
+            flight = self.entry_flights.get(key, None)
+            is_leader = flight is None
+            if is_leader:
+                flight = self.entry_flights[key] = {"event": threading.Event(), "response": None}
+                self.flight_stats["entry_reads"] += 1
+            else:
+                self.flight_stats["entry_coalesced"] += 1
+        if not is_leader:
+            flight["event"].wait()
+            if flight.get("timed_out", False):
+                raise TimeoutError("Operation timed out.")
+            return flight["response"]
+        try:
+            flight["response"] = self.operation_driver(self.query, key)
+        except TimeoutError:
+            flight["timed_out"] = True
+            raise
+        finally:
+            with self.flights_lock:
+                if self.entry_flights.get(key, None) is flight:
+                    del self.entry_flights[key]
+            flight["event"].set()
+        return flight["response"]
+
+    def operation_resp(self, uid, response, owner=None):
+        if uid not in self.pending_requests:
+            self.failure_stats["late_responses"] += 1 # after its deadline
+            return
+        if "waiters" in self.pending_requests[uid]:
+            return self.land_read_flight(uid, response)
+        if owner is not None:
+            self.location_cache.learn(self.pending_requests[uid].get("epoch", None), *owner)
         self.pending_requests[uid]["response"] = response
         self.pending_requests[uid]["event"].set()
 
-def init_app():
-    IS_BOOTSTRAP    = os.environ["IS_BOOTSTRAP"]
-    NODE_URL        = os.environ["NODE_URL"]
-    LOCKING_SRV_URL = os.environ["LOCKING_SRV_URL"]
+    def operation_resp_batch(self, responses):
+        for response in responses:
+            self.operation_resp(**response)
+
+    def reorder_buffer_stats(self):
+        with self.replicate_wakeup_lock:
+            stats = dict(self.reorder_stats)
+            stats["depth"] = len(self.reorder_buffer_replication)
+        stats["avg_wait"] = stats["total_wait"] / stats["messages"] if stats["messages"] > 0 else 0.0
+        return stats
+
+    def stats(self):
+        return {
+                "http_pool": session_pool.stats(),
+                "dispatcher": dispatcher.stats(),
+                "write_batcher": self.write_batcher.stats(),
+                "reorder_buffer": self.reorder_buffer_stats(),
+                "location_cache": self.location_cache.stats(),
+                "membership": self.membership.stats(),
+                "failures": {**self.failure_stats, "successor_list": self.successor_list},
+                "fingers": {**self.finger_stats, "known": sum(node is not None for node in self.fingers),
+                            "distinct": len(self.finger_table)},
+                "change_log": self.change_log.stats(),
+                "storage": {
+                    "backend": storage.STORAGE_BACKEND,
+                    "replicas": [replica.stats() for replica in self.data_store] if self.data_store is not None else [],
+                    },
+                "read_flights": dict(self.flight_stats),
+                "craq": {**self.craq_stats, "dirty_keys": len(self.dirty), "commit_batcher": self.commit_batcher.stats()},
+                "stream": {
+                    "transport": self.transport,
+                    "server": self.stream_server.stats() if self.stream_server is not None else None,
+                    "successor": self.succ_stream.stats() if self.succ_stream is not None else None,
+                    },
+                }
+
+def init_app(config):
+    # the node settings come with /init (the manager claims workers that were started idle),
+    # falling back to the environment
+    config = {**os.environ, **config}
+    IS_BOOTSTRAP    = config["IS_BOOTSTRAP"]
+    NODE_URL        = config["NODE_URL"]
+    LOCKING_SRV_URL = config["LOCKING_SRV_URL"]
+    NODE_STREAM_ADDR = config.get("NODE_STREAM_ADDR", None)
+    storage.configure(config.get("STORAGE_DIR", storage.STORAGE_DIR))
     if IS_BOOTSTRAP=="TRUE":
-        CONSISTENCY_MODEL  = os.environ["CONSISTENCY_MODEL"]
-        REPLICATION_FACTOR = int(os.environ["REPLICATION_FACTOR"])
+        CONSISTENCY_MODEL  = config["CONSISTENCY_MODEL"]
+        REPLICATION_FACTOR = int(config["REPLICATION_FACTOR"])
+        TRANSPORT          = config.get("TRANSPORT", "HTTP")
 
         chord_node = ChordNode(url=NODE_URL, locking_srv_url=LOCKING_SRV_URL,\
-                consistency_model=CONSISTENCY_MODEL, replication_factor=REPLICATION_FACTOR, is_bootstrap=True)
+                consistency_model=CONSISTENCY_MODEL, replication_factor=REPLICATION_FACTOR, transport=TRANSPORT,\
+                stream_addr=NODE_STREAM_ADDR, is_bootstrap=True)
     else:
-        BOOTSTRAP_URL = os.environ["BOOTSTRAP_URL"]
-        chord_node = ChordNode(url=NODE_URL, locking_srv_url=LOCKING_SRV_URL)
+        BOOTSTRAP_URL = config["BOOTSTRAP_URL"]
+        chord_node = ChordNode(url=NODE_URL, locking_srv_url=LOCKING_SRV_URL, stream_addr=NODE_STREAM_ADDR)
+
+    if NODE_STREAM_ADDR is not None:
+        chord_node.start_stream_server()
 
     current_app.chord_node = chord_node
-    if IS_BOOTSTRAP!="TRUE": current_app.chord_node.join_existing(BOOTSTRAP_URL)
+    if IS_BOOTSTRAP!="TRUE" and not chord_node.join_existing(BOOTSTRAP_URL):
+        current_app.chord_node = None # not in the ring: nothing to depart from at exit either
+        return False
+    # the other nodes learn about this one through gossip and their own fix_fingers
+    current_app.chord_node.start_fix_fingers()
+    current_app.chord_node.start_heartbeat()
+    current_app.chord_node.start_checkpoints()
+    current_app.chord_node.start_gossip([] if IS_BOOTSTRAP=="TRUE" else \
+            [BOOTSTRAP_URL, current_app.chord_node.successor_url, current_app.chord_node.predecessor_url])
+    return True
 
 app = Flask(__name__)
 
 def cleanup_app(app):
     with app.app_context():
-        if not current_app.chord_node.is_bootstrap:
-            current_app.chord_node.depart()
+        chord_node = getattr(current_app, "chord_node", None) # None: idle worker, never initialized
+        if chord_node is not None and not chord_node.is_bootstrap:
+            chord_node.depart()
+    session_pool.close()
+
+@app.errorhandler(TimeoutError)
+def handle_timeout(e):
+    return {"error": str(e)}, 504
 
 @app.route("/init", methods=['POST'])
 def handle_init():
-    init_app()
+    if not init_app(request.get_json(silent=True) or {}):
+        return {"error": "Could not join the chord ring."}
     return {}
 
 @app.route('/modify', methods=['POST'])
@@ -557,15 +1722,34 @@ def handle_query_star():
     response = current_app.chord_node.query_star(**data)
     return jsonify({"response": response})
 
+@app.route('/scanPage', methods=['POST'])
+def handle_scan_page():
+    data = request.get_json()
+    current_app.chord_node.scan_page(**data)
+    return jsonify({"response": "Ok scan page"})
+
+@app.route('/batch', methods=['POST'])
+def handle_batch():
+    data = request.get_json()
+    current_app.chord_node.batch(**data)
+    return jsonify({"response": "Ok batch"})
+
 @app.route('/join', methods=['POST'])
 def handle_join():
     data = request.get_json()
     response = current_app.chord_node.join_request(**data)
     return jsonify({"response": response})
 
+@app.route('/transferChunk', methods=['POST'])
+def handle_transfer_chunk():
+    response = current_app.chord_node.receive_chunk(request.args["transfer_id"], int(request.args["replica"]),
+            int(request.args["chunk"]), request.get_data())
+    return jsonify({"response": response})
+
 @app.route('/joinResponse', methods=['POST'])
 def handle_join_response():
     data = request.get_json()
+    data["data_store"] = current_app.chord_node.claim_transfer(data["data_store"])
     response = current_app.chord_node.join_response(**data)
     return jsonify({"response": response})
 
@@ -578,21 +1762,68 @@ def handle_shift_up_replicas():
 @app.route('/shiftDownReplicas', methods=['POST'])
 def handle_shift_down_replicas():
     data = request.get_json()
+    data["maxdistance_replica"] = current_app.chord_node.claim_transfer(data["maxdistance_replica"])[0]
     response = current_app.chord_node.shift_down_replicas(**data)
     return jsonify({"response": response})
 
 @app.route('/departPred', methods=['POST'])
 def handle_depart_pred():
     data = request.get_json()
+    data["maxdistance_replica"] = current_app.chord_node.claim_transfer(data["maxdistance_replica"])[0]
     response = current_app.chord_node.depart_pred(**data)
     return jsonify({"response": response})
 
+@app.route('/changeMarker', methods=['POST'])
+def handle_change_marker():
+    return jsonify({"response": current_app.chord_node.change_log.marker()})
+
 @app.route('/update_succ_info', methods=['POST'])
 def handle_update_succ_info():
     data = request.get_json()
     response = current_app.chord_node.update_succ_info(**data)
     return jsonify({"response": response})
 
+@app.route('/findSuccessor', methods=['POST'])
+def handle_find_successor():
+    data = request.get_json()
+    return jsonify({"response": current_app.chord_node.find_successor(**data)})
+
+@app.route('/chainArc', methods=['POST'])
+def handle_chain_arc():
+    data = request.get_json()
+    return jsonify({"response": current_app.chord_node.chain_arc(**data)})
+
+@app.route('/chainEnd', methods=['POST'])
+def handle_chain_end():
+    data = request.get_json()
+    return jsonify({"response": current_app.chord_node.chain_end(**data)})
+
+@app.route('/joinArc', methods=['POST'])
+def handle_join_arc():
+    data = request.get_json()
+    return jsonify({"response": current_app.chord_node.join_arc(**data)})
+
+@app.route('/gossip', methods=['POST'])
+def handle_gossip():
+    data = request.get_json()
+    current_app.chord_node.merge_members(data["members"])
+    return jsonify({"response": current_app.chord_node.membership.snapshot()})
+
+@app.route('/successorList', methods=['POST'])
+def handle_successor_list():
+    return jsonify({"response": current_app.chord_node.successor_list})
+
+@app.route('/predFailed', methods=['POST'])
+def handle_pred_failed():
+    data = request.get_json()
+    data["maxdistance_replica"] = current_app.chord_node.claim_transfer(data["maxdistance_replica"])[0]
+    response = current_app.chord_node.pred_failed(**data)
+    return jsonify({"response": response})
+
+@app.route('/streamAddr', methods=['POST'])
+def handle_stream_addr():
+    return jsonify({"response": current_app.chord_node.stream_addr})
+
 @app.route('/operation_resp', methods=['POST'])
 def handle_operation_resp():
     data = request.get_json()
@@ -605,6 +1836,24 @@ def handle_replicate_modify():
     response = current_app.chord_node.replicate_modify(**data)
     return jsonify({"response": "Ok replicate modify"})
 
+@app.route('/operation_resp_batch', methods=['POST'])
+def handle_operation_resp_batch():
+    data = request.get_json()
+    current_app.chord_node.operation_resp_batch(**data)
+    return jsonify({"response": "Ok operation resp batch"})
+
+@app.route('/replicateModifyBatch', methods=['POST'])
+def handle_replicate_modify_batch():
+    data = request.get_json()
+    response = current_app.chord_node.replicate_modify_batch(**data)
+    return jsonify({"response": "Ok replicate modify batch"})
+
+@app.route('/commitModify', methods=['POST'])
+def handle_commit_modify():
+    data = request.get_json()
+    current_app.chord_node.commit_modify(**data)
+    return jsonify({"response": "Ok commit modify"})
+
 @app.route('/replicateQuery', methods=['POST'])
 def handle_replicate_query():
     data = request.get_json()
@@ -658,8 +1907,18 @@ def handle_api_query():
     key = data["key"]
     if key == "*":
         response = current_app.chord_node.operation_driver(current_app.chord_node.query_star, None)
+    elif data.get("direct", False):
+        response, misrouted = current_app.chord_node.direct_query(key)
+        return {"response": response, "misrouted": misrouted}
     else:
-        response = current_app.chord_node.operation_driver(current_app.chord_node.query, key)
+        response = current_app.chord_node.entry_query(key)
+    return {"response": response}
+
+@app.route("/api/scan", methods=['POST'])
+@schemas.validate_json(schemas.API_SCAN_SCHEMA)
+def handle_api_scan():
+    data = request.get_json()
+    response = current_app.chord_node.scan(data.get("cursor", None), data.get("page_size", 1000))
     return {"response": response}
 
 @app.route("/api/modify", methods=['POST'])
@@ -673,12 +1932,33 @@ def handle_api_modify():
             value = data["value"]
         case "delete":
             value = None
+    # a smart client sends writes straight to the head. if its view of the ring is stale the write is
+    # still routed, but the client is told to refresh it.
+    misrouted = data.get("direct", False) and not current_app.chord_node.is_responsible(current_app.chord_node.hash_id(key))
     response = current_app.chord_node.operation_driver(current_app.chord_node.modify, operation, key, value)
+    if data.get("direct", False):
+        return {"response": response, "misrouted": misrouted}
+    return {"response": response}
+
+@app.route("/api/batch", methods=['POST'])
+@schemas.validate_json(schemas.API_BATCH_SCHEMA)
+def handle_api_batch():
+    data = request.get_json()
+    response = current_app.chord_node.batch_operation_driver(data["operations"])
     return {"response": response}
 
 @app.route("/api/overlay", methods=['POST'])
 @schemas.validate_json(schemas.API_OVERLAY_SCHEMA)
 def handle_api_overlay():
-    response = current_app.chord_node.operation_driver(current_app.chord_node.overlay, None)
+    # from the gossiped membership view, or {"walk": true} for a walk around the ring
+    if request.get_json().get("walk", False):
+        response = current_app.chord_node.operation_driver(current_app.chord_node.overlay, None)
+    else:
+        response = current_app.chord_node.membership_overlay()
     return {"response": response}
 
+@app.route("/api/stats", methods=['POST'])
+@schemas.validate_json(schemas.API_STATS_SCHEMA)
+def handle_api_stats():
+    return {"response": current_app.chord_node.stats()}
+
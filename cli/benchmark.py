@@ -7,6 +7,12 @@ import tqdm
 
 REPLICATION_FACTORS = [1,3,5]
 CONSISTENCY_MODELS = ["LINEARIZABLE", "EVENTUAL"]
+# replication transports to compare, e.g. CHORD_BENCH_TRANSPORTS=HTTP,STREAM
+TRANSPORTS = os.environ.get("CHORD_BENCH_TRANSPORTS", "HTTP").split(",")
+# >0: send the operations through the bulk (/api/batch) endpoint, this many per request
+BATCH_SIZE = int(os.environ.get("CHORD_BENCH_BATCH_SIZE", "0"))
+# route each operation straight to the node serving its key (see cli.Client smart mode)
+SMART_CLIENT = os.environ.get("CHORD_BENCH_SMART_CLIENT", "FALSE") == "TRUE"
 
 
 INSERTS  = [None for _ in range(10)]
@@ -34,7 +40,7 @@ def calculate_indexes(node_index):
     return physical_idx, logical_idx
 
 
-def benchmark_driver(client_factory, consistency_model, replication_factor):
+def benchmark_driver(client_factory, consistency_model, replication_factor, transport):
     print("Setting up...")
 
     client = client_factory()
@@ -44,18 +50,17 @@ def benchmark_driver(client_factory, consistency_model, replication_factor):
 
     with tqdm.tqdm(total=10) as pbar:
         client.physical = "vm1"
-        client.spawn_bootstrap(consistency_model, replication_factor)
+        client.spawn_bootstrap(consistency_model, replication_factor, transport)
         pbar.update(1)
-        client.spawn()
+        # the last spawn rebuilds all finger tables, so that the benchmark starts with complete ones
+        others = [physical for physical in client.physical_urls if physical != "vm1"]
+        client.spawn(count=1, update_fingers=not others)
         pbar.update(1)
 
-        for physical in client.physical_urls:
-            if physical == "vm1": continue
+        for i, physical in enumerate(others):
             client.physical = physical
-            client.spawn()
-            pbar.update(1)
-            client.spawn()
-            pbar.update(1)
+            client.spawn(count=2, update_fingers=(i == len(others)-1))
+            pbar.update(2)
 
     times_bench1 = [None for _ in range(10)]
     times_bench2 = [None for _ in range(10)]
@@ -70,16 +75,28 @@ def benchmark_driver(client_factory, consistency_model, replication_factor):
         client.logical = str(logical_idx)
 
         t_start = time.time()
-        for insert_key in INSERTS[node_index]:
-            client.modify("insert", insert_key, INSERT_VALUE)
-            pbar.update(1)
+        if BATCH_SIZE > 0:
+            for i in range(0, len(INSERTS[node_index]), BATCH_SIZE):
+                keys = INSERTS[node_index][i:i+BATCH_SIZE]
+                client.insert_many([(insert_key, INSERT_VALUE) for insert_key in keys])
+                pbar.update(len(keys))
+        else:
+            for insert_key in INSERTS[node_index]:
+                client.modify("insert", insert_key, INSERT_VALUE)
+                pbar.update(1)
         t_end = time.time()
         times_bench1[node_index] = t_end-t_start
 
         t_start = time.time()
-        for query_key in QUERIES[node_index]:
-            client.query(query_key)
-            pbar.update(1)
+        if BATCH_SIZE > 0:
+            for i in range(0, len(QUERIES[node_index]), BATCH_SIZE):
+                keys = QUERIES[node_index][i:i+BATCH_SIZE]
+                client.query_many(keys)
+                pbar.update(len(keys))
+        else:
+            for query_key in QUERIES[node_index]:
+                client.query(query_key)
+                pbar.update(1)
         t_end = time.time()
         times_bench2[node_index] = t_end-t_start
 
@@ -104,10 +121,11 @@ def benchmark_driver(client_factory, consistency_model, replication_factor):
 
 def run_benchmarks(client_factory):
     results = {}
-    for replication_factor in REPLICATION_FACTORS:
-        for consistency_model in CONSISTENCY_MODELS:
-            result = benchmark_driver(client_factory, consistency_model, replication_factor)
-            results[(consistency_model, replication_factor)] = result
+    for transport in TRANSPORTS:
+        for replication_factor in REPLICATION_FACTORS:
+            for consistency_model in CONSISTENCY_MODELS:
+                result = benchmark_driver(client_factory, consistency_model, replication_factor, transport)
+                results[(transport, consistency_model, replication_factor)] = result
     return results
 
 
@@ -138,7 +156,8 @@ if __name__ == "__main__":
             physical_urls=configuration.physical_urls,
             username=configuration.http_username,
             password=configuration.http_password,
-            ssl_verify=CHORD_CLI_SSL_VERIFY
+            ssl_verify=CHORD_CLI_SSL_VERIFY,
+            smart=SMART_CLIENT
             )
 
     results = run_benchmarks(client_factory)
@@ -148,10 +167,11 @@ if __name__ == "__main__":
     else:
         f = open("meas.csv", "w", newline='')
     with f:
-        writer = csv.DictWriter(f, fieldnames=["consistency_model", "replication_factor", "time_bench1", "time_bench2"])
+        writer = csv.DictWriter(f, fieldnames=["transport", "consistency_model", "replication_factor", "time_bench1", "time_bench2"])
         writer.writeheader()
-        for (consistency_model, replication_factor), (time_bench1, time_bench2) in results.items():
+        for (transport, consistency_model, replication_factor), (time_bench1, time_bench2) in results.items():
             writer.writerow({
+                "transport": transport,
                 "consistency_model": consistency_model,
                 "replication_factor": replication_factor,
                 "time_bench1": time_bench1,
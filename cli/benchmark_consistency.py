@@ -55,16 +55,15 @@ def benchmark_driver(client_factory, consistency_model, replication_factor, sche
         client.physical = "vm1"
         client.spawn_bootstrap(consistency_model, replication_factor)
         pbar.update(1)
-        client.spawn()
+        # the last spawn rebuilds all finger tables, so that the benchmark starts with complete ones
+        others = [physical for physical in client.physical_urls if physical != "vm1"]
+        client.spawn(count=1, update_fingers=not others)
         pbar.update(1)
 
-        for physical in client.physical_urls:
-            if physical == "vm1": continue
+        for i, physical in enumerate(others):
             client.physical = physical
-            client.spawn()
-            pbar.update(1)
-            client.spawn()
-            pbar.update(1)
+            client.spawn(count=2, update_fingers=(i == len(others)-1))
+            pbar.update(2)
 
     dht = defaultdict(lambda: "")
     stale_reads = 0
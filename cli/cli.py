@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 import readline
+import bisect
+import hashlib
+import random
 import sys
 import os
+import json
 import requests
+from requests.adapters import HTTPAdapter
 
 COMMANDS = [
-    "insert", "delete", "query", "depart", "overlay",
+    "insert", "delete", "query", "depart", "overlay", "stats",
     "exit", "list-physicals", "set-physical", "list-logicals", "set-logical",
     "show-selected", "spawn", "spawn-bootstrap", "killall", "help"
 ]
@@ -18,28 +23,44 @@ def autocompleter(text, state):
         return None
 
 class Client:
-    def __init__(self, physical_urls, username=None, password=None, ssl_verify=True):
+    def __init__(self, physical_urls, username=None, password=None, ssl_verify=True, max_connections=10, smart=False):
         self.physical_urls = physical_urls
         self.physical = None
         self.logical = None
         self.ssl_verify = ssl_verify
 
+        # smart mode: operations are sent straight to the node serving the key,
+        # using a cached view of the ring (refreshed when a node reports a misroute).
+        self.smart = smart
+        self.ring = None
+
         if username is not None:
             self.auth = requests.auth.HTTPBasicAuth(username, password)
         else:
             self.auth = None
 
-    def send_request(self, endpoint, data={}, manager=False):
-        if manager:
-            response = requests.post(f"{self.physical_url}/management/{endpoint}", auth=self.auth, json=data, verify=self.ssl_verify)
-        else:
-            response = requests.post(f"{self.url}/api/{endpoint}", auth=self.auth, json=data, verify=self.ssl_verify)
-        response = response.json()
+        # keep-alive connections, one pool per physical node (requests keys the pools by host).
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max(len(physical_urls), 1), pool_maxsize=max_connections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def post(self, url, data):
+        return self.session.post(url, auth=self.auth, json=data, verify=self.ssl_verify).json()
+
+    def exit_on_error(self, response):
         if "error" in response:
             print(f"Response Error: {response['error']}", flush=True)
             print("Exiting CLI.", flush=True)
             sys.exit(1)
 
+    def send_request(self, endpoint, data={}, manager=False):
+        if manager:
+            response = self.post(f"{self.physical_url}/management/{endpoint}", data)
+        else:
+            response = self.post(f"{self.url}/api/{endpoint}", data)
+        self.exit_on_error(response)
+
         if manager:
             return response
         else:
@@ -56,32 +77,130 @@ class Client:
     def list_logicals(self):
         return self.send_request("list", manager=True)
 
-    def spawn(self):
-        return self.send_request("spawn", manager=True)
+    def spawn(self, count=None, update_fingers=None):
+        # count: several nodes in one call. update_fingers: rebuild all finger tables right away
+        return self.send_request("spawn", manager=True, data={
+            **({"count": count} if count is not None else {}),
+            **({"update_fingers": update_fingers} if update_fingers is not None else {})
+            })
 
-    def spawn_bootstrap(self, consistency_model, replication_factor):
+    def spawn_bootstrap(self, consistency_model, replication_factor, transport=None):
         return self.send_request("spawnBootstrap", manager=True, data={
             "consistency_model": consistency_model,
-            "replication_factor": replication_factor
+            "replication_factor": replication_factor,
+            **({"transport": transport} if transport is not None else {})
             })
 
     def killall(self):
         return self.send_request("killall", manager=True)
 
 
+    @staticmethod
+    def hash_id(value):
+        # same as the nodes' hash
+        return int.from_bytes( hashlib.sha1(value.encode()).digest(), byteorder="little")
+
+    def refresh_ring(self):
+        # node urls are reported with the base url of their physical node, which is mapped back to the url
+        # this client uses for it.
+        client_urls = {}
+        for physical_url in self.physical_urls.values():
+            try:
+                client_urls[self.post(f"{physical_url}/management/info", {})["base_url"]] = physical_url
+            except (requests.RequestException, ValueError, KeyError):
+                continue # unreachable physical node
+        nodes = sorted(self.overlay(), key=lambda node: int(node["keys_end"]))
+        self.ring = {
+                "ends": [int(node["keys_end"]) for node in nodes],
+                "urls": [f"{client_urls[base]}/{node_id}" if base in client_urls else None
+                         for base, node_id in (node["url"].rsplit("/", 1) for node in nodes)],
+                "replication_factor": nodes[0]["replication_factor"],
+                "consistency_model": nodes[0]["consistency_model"],
+                }
+
+    def chain_url(self, key, distance):
+        # url of the node at `distance` down the chain of the key (0: head, replication_factor-1: tail)
+        if self.ring is None:
+            self.refresh_ring()
+        ends = self.ring["ends"]
+        head = bisect.bisect_left(ends, self.hash_id(key)) % len(ends)
+        return self.ring["urls"][(head + distance) % len(ends)]
+
+    def direct_request(self, endpoint, data, node_url):
+        if node_url is not None:
+            try:
+                resp = self.session.post(f"{node_url}/api/{endpoint}", auth=self.auth,
+                        json={**data, "direct": True}, verify=self.ssl_verify)
+                if resp.status_code == 504:
+                    # the operation timed out (at the node or on the way to it): it may still be applied,
+                    # so it is not sent again
+                    self.exit_on_error({"error": "Operation timed out."})
+                response = resp.json()
+            except (requests.RequestException, ValueError):
+                response = None
+            if response is not None and "error" not in response:
+                if response.get("misrouted", False):
+                    self.ring = None # stale view. refreshed on the next operation.
+                return response["response"]
+        # the node is gone (or unknown): go through the selected node
+        self.ring = None
+        return self.send_request(endpoint, data)
+
     def modify(self, operation, key, value=None):
-        return self.send_request("modify", {"operation": operation, "key": key, **({"value":value} if value is not None else {})})
+        data = {"operation": operation, "key": key, **({"value":value} if value is not None else {})}
+        if self.smart and self.logical is not None:
+            # writes enter the chain at its head
+            return self.direct_request("modify", data, self.chain_url(key, 0))
+        return self.send_request("modify", data)
 
     def query(self, key):
+        if self.smart and self.logical is not None and key != "*":
+            # eventual reads are served by the head of the chain. linearizable reads by any of its replicas
+            # (a replica holding an uncommitted write for the key passes the read on towards the tail).
+            url = self.chain_url(key, 0)
+            if self.ring["consistency_model"] == "LINEARIZABLE":
+                url = self.chain_url(key, random.randrange(self.ring["replication_factor"]))
+            return self.direct_request("query", {"key": key}, url)
         return self.send_request("query", {"key": key})
 
+    def batch(self, operations):
+        # operations: list of {"operation": "insert"/"delete"/"query", "key": ..., ["value": ...]}
+        # returns the per-operation responses, in order
+        return self.send_request("batch", {"operations": operations})
+
+    def insert_many(self, items):
+        return self.batch([{"operation": "insert", "key": key, "value": value} for key, value in items])
+
+    def query_many(self, keys):
+        return self.batch([{"operation": "query", "key": key} for key in keys])
+
+    def scan(self, cursor=None, page_size=None):
+        return self.send_request("scan", {
+            **({"cursor": cursor} if cursor is not None else {}),
+            **({"page_size": page_size} if page_size is not None else {})
+            })
+
+    def scan_all(self, page_size=None):
+        # yields every (key, value) of the DHT, fetching one page at a time
+        cursor = None
+        while True:
+            page = self.scan(cursor, page_size)
+            yield from page["items"].items()
+            cursor = page["cursor"]
+            if cursor is None:
+                break
+
     def depart(self):
         resp = self.send_request("depart")
         self.logical = None
         return resp
 
-    def overlay(self):
-        return self.send_request("overlay")
+    def overlay(self, walk=False):
+        # walk: exact ring walk, instead of the node's gossiped view
+        return self.send_request("overlay", data={"walk": True} if walk else {})
+
+    def stats(self):
+        return self.send_request("stats")
 
     def cli(self):
         print("Chord DHT Client. Type 'help' for available commands.", flush=True)
@@ -92,7 +211,7 @@ class Client:
                     continue
                 args = command.split()
                 cmd = args[0].lower()
-                if cmd in ["insert", "delete", "query", "depart", "overlay"]:
+                if cmd in ["insert", "delete", "query", "depart", "overlay", "stats"]:
                     if self.physical is None:
                         print("Please set a physical node.", flush=True)
                         continue
@@ -118,19 +237,25 @@ class Client:
                         print("Usage: query <key>", flush=True)
                         continue
                     key = args[1]
+                    if key == "*":
+                        for key, value in self.scan_all():
+                            print(f"{key}: {value}", flush=True)
+                        continue
                     response = self.query(key)
                     print(response, flush=True)
                 elif cmd == "depart":
                     response = self.depart()
                     print(response, flush=True)
                 elif cmd == "overlay":
-                    nodes = self.overlay()
+                    nodes = self.overlay(walk=len(args) >= 2 and args[1] == "walk")
                     print("Overlay (Chord Ring Topology):", flush=True)
                     for node in nodes:
                         print(f"Node {node['url']}", flush=True)
                         print(f"  Predecessor {node['successor_url']}", flush=True)
                         print(f"  Successor {node['predecessor_url']}", flush=True)
                         print(f"  Key Range {node['keys_start']} -- {node['keys_end']}", flush=True)
+                elif cmd == "stats":
+                    print(json.dumps(self.stats(), indent=2), flush=True)
                 elif cmd == "exit":
                     break
                 elif cmd == "list-physicals":
@@ -171,15 +296,28 @@ class Client:
                     if self.physical is None:
                         print("Please set a physical node.", flush=True)
                         continue
-                    resp = self.spawn()
+                    count = None
+                    if len(args) >= 2:
+                        try:
+                            count = int(args[1])
+                            if count < 1:
+                                raise ValueError
+                        except ValueError:
+                            print("Count must be a positive integer.", flush=True)
+                            continue
+                    resp = self.spawn(count)
                     print(resp, flush=True)
                 elif cmd == "spawn-bootstrap":
                     if len(args) < 3:
-                        print("Usage: spawn-bootstrap <Consistency Model> <Replication Factor>", flush=True)
+                        print("Usage: spawn-bootstrap <Consistency Model> <Replication Factor> [<Transport>]", flush=True)
                         continue
                     if args[1] not in ["LINEARIZABLE", "EVENTUAL"]:
                         print("Unsupported Consistency Model.", flush=True)
                         continue
+                    transport = args[3] if len(args) >= 4 else None
+                    if transport not in [None, "HTTP", "STREAM"]:
+                        print("Unsupported Transport.", flush=True)
+                        continue
                     try:
                         rf = int(args[2])
                         if rf < 1:
@@ -191,7 +329,7 @@ class Client:
                     if self.physical is None:
                         print("Please set a physical node.", flush=True)
                         continue
-                    resp = self.spawn_bootstrap(consistency_model=args[1], replication_factor=int(args[2]))
+                    resp = self.spawn_bootstrap(consistency_model=args[1], replication_factor=int(args[2]), transport=transport)
                     print(resp, flush=True)
                 elif cmd == "killall":
                     if self.physical is None:
@@ -210,7 +348,7 @@ class Client:
                     print("-- Physical Node Management -- ")
                     print(" spawn-bootstrap       - Spawns a new Bootstrap Logical node (at the current Physical Node - if it the designated node)",
                           flush=True)
-                    print(" spawn                 - Spawns a new Logical node (at the current Physical Node)", flush=True)
+                    print(" spawn [<count>]       - Spawns new Logical node(s) (at the current Physical Node)", flush=True)
                     print(" killall               - Kills all Logical nodes (in the current Physical Node)", flush=True)
                     print("-- Chord Operations -- ")
 
@@ -218,7 +356,8 @@ class Client:
                     print(" delete <key>          - Delete the specified key", flush=True)
                     print(" query <key>           - Query for the specified key (use '*' for all keys)", flush=True)
                     print(" depart                - Gracefully depart from the DHT", flush=True)
-                    print(" overlay               - Print the network topology", flush=True)
+                    print(" overlay [walk]        - Print the network topology ('walk': exact, around the ring)", flush=True)
+                    print(" stats                 - Print the node's runtime counters (e.g. connection reuse)", flush=True)
                     print("-- CLI Operations -- ")
                     print(" exit                  - Exit the CLI", flush=True)
                     print(" help                  - Show this help message", flush=True)
@@ -0,0 +1,164 @@
+import threading
+import traceback
+from collections import deque
+
+
+class Dispatcher:
+    # Bounded fire-and-forget executor for outbound messages.
+    # Messages are queued per destination and sent by a fixed budget of worker threads
+    # (greenlets under gevent), instead of starting a new thread for every message.
+    #
+    # When the queue of a destination is full the message is sent by the caller itself
+    # ("caller runs"). This throttles the producer without ever dropping a message and
+    # without blocking a handler on queue space (which could deadlock around the ring).
+    def __init__(self, send, workers=32, max_queue_depth=1024, max_inflight_per_destination=8):
+        self.send = send
+        self.workers = workers
+        self.max_queue_depth = max_queue_depth
+        self.max_inflight_per_destination = max_inflight_per_destination
+
+        self.cv = threading.Condition()
+        self.queues   = {}      # destination -> deque of messages
+        self.inflight = {}      # destination -> number of messages being sent
+        self.ready    = deque() # destinations with queued messages and a free inflight slot
+        self.started  = 0
+
+        self.submitted  = 0
+        self.sent       = 0
+        self.caller_ran = 0
+        self.errors     = 0
+        self.max_depth  = 0
+
+    def is_ready(self, destination):
+        # caller holds self.cv
+        return len(self.queues.get(destination, ())) > 0 and \
+                self.inflight.get(destination, 0) < self.max_inflight_per_destination and \
+                destination not in self.ready
+
+    def submit(self, destination, *message):
+        with self.cv:
+            self.submitted += 1
+            queue = self.queues.setdefault(destination, deque())
+            if len(queue) >= self.max_queue_depth:
+                self.caller_ran += 1
+                run_inline = True
+            else:
+                run_inline = False
+                queue.append(message)
+                self.max_depth = max(self.max_depth, len(queue))
+                if self.is_ready(destination):
+                    self.ready.append(destination)
+                    self.cv.notify()
+                if self.started < self.workers:
+                    self.started += 1
+                    threading.Thread(target=self.worker, daemon=True).start()
+
+        if run_inline:
+            self.deliver(message)
+
+    def deliver(self, message):
+        try:
+            self.send(*message)
+            with self.cv:
+                self.sent += 1
+        except Exception:
+            with self.cv:
+                self.errors += 1
+            traceback.print_exc()
+
+    def worker(self):
+        while True:
+            with self.cv:
+                self.cv.wait_for(lambda: len(self.ready) > 0)
+                destination = self.ready.popleft()
+                message = self.queues[destination].popleft()
+                self.inflight[destination] = self.inflight.get(destination, 0) + 1
+                if self.is_ready(destination):
+                    self.ready.append(destination)
+                    self.cv.notify()
+
+            self.deliver(message)
+
+            with self.cv:
+                self.inflight[destination] -= 1
+                if self.inflight[destination] == 0 and len(self.queues[destination]) == 0:
+                    del self.inflight[destination]
+                    del self.queues[destination]
+                elif self.is_ready(destination):
+                    self.ready.append(destination)
+                    self.cv.notify()
+
+    def pending(self):
+        with self.cv:
+            return sum(len(queue) for queue in self.queues.values()) + sum(self.inflight.values())
+
+    def stats(self):
+        with self.cv:
+            return {
+                "workers": self.started,
+                "submitted": self.submitted,
+                "sent": self.sent,
+                "caller_ran": self.caller_ran,
+                "errors": self.errors,
+                "max_queue_depth_seen": self.max_depth,
+                "queue_depths": {destination: len(queue) for destination, queue in self.queues.items()},
+            }
+
+
+class Batcher:
+    # Group commit: items submitted concurrently are coalesced into batches of at most max_size
+    # items, waiting at most `window` seconds after the first item of a batch.
+    # A single thread flushes the batches, so they are flushed in submission order.
+    def __init__(self, flush, max_size=64, window=0.002):
+        self.flush = flush
+        self.max_size = max_size
+        self.window = window
+
+        self.cv = threading.Condition()
+        self.items = deque()
+        self.flushing = False
+        self.thread = None
+
+        self.batches = 0
+        self.flushed_items = 0
+        self.max_batch = 0
+
+    def submit(self, item):
+        with self.cv:
+            self.items.append(item)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.cv.notify()
+
+    def run(self):
+        while True:
+            with self.cv:
+                self.cv.wait_for(lambda: len(self.items) > 0)
+                self.cv.wait_for(lambda: len(self.items) >= self.max_size, timeout=self.window)
+                batch = [self.items.popleft() for _ in range(min(self.max_size, len(self.items)))]
+                self.flushing = True
+
+            try:
+                self.flush(batch)
+            except Exception:
+                traceback.print_exc()
+
+            with self.cv:
+                self.flushing = False
+                self.batches += 1
+                self.flushed_items += len(batch)
+                self.max_batch = max(self.max_batch, len(batch))
+
+    def pending(self):
+        with self.cv:
+            return len(self.items) + (1 if self.flushing else 0)
+
+    def stats(self):
+        with self.cv:
+            return {
+                "batches": self.batches,
+                "items": self.flushed_items,
+                "max_batch": self.max_batch,
+                "queued": len(self.items),
+            }
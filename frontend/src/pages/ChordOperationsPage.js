@@ -46,7 +46,14 @@ function ChordOperationsPage() {
 
   const onQueryAll = async () => {
     ensureWorkerSelected();
-    const resp = await chordRequest(managerBaseURL, selectedWorkerId, 'query', { key: '*' });
+    // page through the whole ring, instead of one response holding every key
+    const resp = {};
+    let cursor = null;
+    do {
+      const page = await chordRequest(managerBaseURL, selectedWorkerId, 'scan', cursor ? { cursor } : {});
+      Object.assign(resp, page.items);
+      cursor = page.cursor;
+    } while (cursor);
     return resp;
   };
 
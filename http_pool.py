@@ -0,0 +1,91 @@
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class SessionPool:
+    # One keep-alive requests.Session per destination (scheme + host), so that consecutive
+    # messages to the same physical node reuse their TCP connections instead of paying
+    # the connection setup (and the nginx/manager accept path) on every hop.
+    def __init__(self, max_destinations=64, max_connections=32, idle_timeout=60.0):
+        self.max_destinations = max_destinations
+        self.max_connections  = max_connections
+        self.idle_timeout     = idle_timeout
+
+        self.sessions = OrderedDict() # destination -> (session, last_used). LRU order.
+        self.lock = threading.Lock()
+
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+
+    @staticmethod
+    def destination(url):
+        parsed = urllib.parse.urlsplit(url)
+        return f"{parsed.scheme}://{parsed.netloc}"
+
+    def new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_connections, pool_block=False)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def evict_idle(self, now):
+        # caller holds self.lock
+        evicted = []
+        for destination, (session, last_used) in list(self.sessions.items()):
+            if now - last_used < self.idle_timeout:
+                break # LRU order: the rest are more recent
+            evicted.append(self.sessions.pop(destination)[0])
+        while len(self.sessions) > self.max_destinations:
+            evicted.append(self.sessions.popitem(last=False)[1][0])
+        self.evictions += len(evicted)
+        return evicted
+
+    def get(self, url):
+        destination = self.destination(url)
+        now = time.monotonic()
+        with self.lock:
+            if destination in self.sessions:
+                self.hits += 1
+                session = self.sessions.pop(destination)[0]
+            else:
+                self.misses += 1
+                session = self.new_session()
+            self.sessions[destination] = (session, now)
+            evicted = self.evict_idle(now)
+
+        for old_session in evicted:
+            old_session.close()
+        return session
+
+    def post(self, url, **kwargs):
+        return self.get(url).post(url, **kwargs)
+
+    def stats(self):
+        with self.lock:
+            destinations = {}
+            for destination, (session, last_used) in self.sessions.items():
+                connections, reqs = 0, 0
+                for pool in session.get_adapter(destination).poolmanager.pools.values():
+                    connections += pool.num_connections
+                    reqs        += pool.num_requests
+                destinations[destination] = {"connections_opened": connections, "requests": reqs}
+            return {
+                "session_hits": self.hits,
+                "session_misses": self.misses,
+                "session_evictions": self.evictions,
+                "destinations": destinations,
+            }
+
+    def close(self):
+        with self.lock:
+            sessions = [session for session, _ in self.sessions.values()]
+            self.sessions.clear()
+        for session in sessions:
+            session.close()
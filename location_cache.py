@@ -0,0 +1,76 @@
+import bisect
+import threading
+from collections import OrderedDict
+
+
+class LocationCache:
+    # Bounded LRU of ring ranges [keys_start, keys_end] -> url of the node responsible for them,
+    # learned from completed operations, so that a request for a hot range is sent in one hop.
+    #
+    # Every membership change bumps the epoch, which drops all entries. Hints are learned only
+    # if they were requested in the current epoch, so a stale range is never (re)inserted.
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+
+        self.lock = threading.Lock()
+        self.epoch   = 0
+        self.entries = OrderedDict() # keys_end -> (keys_start, url). LRU order.
+        self.ends    = []            # sorted keys_end, to find the range of a hash with a bisect
+
+        self.hits          = 0
+        self.misses        = 0
+        self.learned       = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def lies_in_range(start, end, key_hash):
+        # see ChordNode.lies_in_range
+        return (start == end) or \
+            (start <= key_hash <= end) or \
+            (end < start <= key_hash) or \
+            (key_hash <= end < start)
+
+    def lookup(self, key_hash):
+        with self.lock:
+            if self.ends:
+                # ranges are disjoint: the only candidate is the first one ending at or after the hash
+                # (or the one wrapping around 0)
+                end = self.ends[bisect.bisect_left(self.ends, key_hash) % len(self.ends)]
+                start, url = self.entries[end]
+                if self.lies_in_range(start, end, key_hash):
+                    self.entries.move_to_end(end)
+                    self.hits += 1
+                    return url
+            self.misses += 1
+            return None
+
+    def learn(self, epoch, keys_start, keys_end, url):
+        with self.lock:
+            if epoch != self.epoch:
+                return # requested before a membership change
+            if keys_end not in self.entries:
+                bisect.insort(self.ends, keys_end)
+            self.entries[keys_end] = (keys_start, url)
+            self.entries.move_to_end(keys_end)
+            self.learned += 1
+            while len(self.entries) > self.max_entries:
+                old_end, _ = self.entries.popitem(last=False)
+                del self.ends[bisect.bisect_left(self.ends, old_end)]
+
+    def invalidate(self):
+        with self.lock:
+            self.epoch += 1
+            self.entries.clear()
+            self.ends = []
+            self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "epoch": self.epoch,
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "learned": self.learned,
+                "invalidations": self.invalidations,
+            }
@@ -1,29 +1,146 @@
+import os
 import threading
-from flask import Flask, current_app
+import time
+import uuid
+from flask import Flask, current_app, request
+
+# a lock that is not released (or renewed) within its lease is dropped, so a crashed holder
+# does not block the ring forever. Holders renew their locks every LOCK_RENEW_INTERVAL seconds.
+LOCK_LEASE = float(os.environ.get("LOCK_LEASE", "120"))
+
+
+class RangeLocks:
+    # Locks over arcs [start, end] of the hash ring (inclusive, may wrap around 0). An arc of None
+    # is the whole ring. Membership changes lock the arc of the nodes they touch, so that joins and
+    # departures in disjoint parts of the ring run in parallel.
+    #
+    # Waiters are served in FIFO order among the ones they conflict with: a request is granted when it
+    # overlaps no held lock and no earlier waiter. A request that conflicts with nobody is not held back
+    # by the queue.
+    def __init__(self):
+        self.cv = threading.Condition()
+        self.held    = {} # lock_id -> (arc, lease expiry)
+        self.waiting = [] # (lock_id, arc), oldest first
+
+        self.granted = 0
+        self.expired = 0
+        self.max_waiting = 0
+
+    @staticmethod
+    def lies_in_range(start, end, key_hash):
+        # see ChordNode.lies_in_range
+        return (start == end) or \
+            (start <= key_hash <= end) or \
+            (end < start <= key_hash) or \
+            (key_hash <= end < start)
+
+    @classmethod
+    def overlap(cls, a, b):
+        if a is None or b is None:
+            return True
+        return cls.lies_in_range(a[0], a[1], b[0]) or cls.lies_in_range(b[0], b[1], a[0])
+
+    def expire(self):
+        # caller holds self.cv
+        now = time.monotonic()
+        for lock_id, (_, expiry) in list(self.held.items()):
+            if expiry <= now:
+                print(f"Lock {lock_id} lease expired.", flush=True)
+                del self.held[lock_id]
+                self.expired += 1
+                self.cv.notify_all()
+
+    def can_grant(self, lock_id, arc):
+        # caller holds self.cv
+        if any(self.overlap(arc, held_arc) for held_arc, _ in self.held.values()):
+            return False
+        for waiting_id, waiting_arc in self.waiting:
+            if waiting_id == lock_id:
+                return True
+            if self.overlap(arc, waiting_arc):
+                return False
+        return True
+
+    def next_expiry(self):
+        # caller holds self.cv
+        if not self.held:
+            return None
+        return max(0, min(expiry for _, expiry in self.held.values()) - time.monotonic())
+
+    def acquire(self, arc, lease):
+        lock_id = uuid.uuid4().hex
+        with self.cv:
+            self.waiting.append((lock_id, arc))
+            self.max_waiting = max(self.max_waiting, len(self.waiting))
+            while True:
+                self.expire()
+                if self.can_grant(lock_id, arc):
+                    break
+                self.cv.wait(timeout=self.next_expiry())
+            self.waiting.remove((lock_id, arc))
+            self.held[lock_id] = (arc, time.monotonic() + lease)
+            self.granted += 1
+            self.cv.notify_all() # waiters behind this one may be grantable now
+        return lock_id
+
+    def release(self, lock_id):
+        with self.cv:
+            if self.held.pop(lock_id, None) is None:
+                return False
+            self.cv.notify_all()
+            return True
+
+    def renew(self, lock_id, lease):
+        with self.cv:
+            if lock_id not in self.held:
+                return False
+            arc, _ = self.held[lock_id]
+            self.held[lock_id] = (arc, time.monotonic() + lease)
+            return True
+
+    def stats(self):
+        with self.cv:
+            return {
+                "held": len(self.held),
+                "waiting": len(self.waiting),
+                "granted": self.granted,
+                "expired": self.expired,
+                "max_waiting": self.max_waiting,
+            }
+
 
 def create_app():
     app = Flask(__name__)
     with app.app_context():
-        current_app.allow_net_changes_cv = threading.Condition()
-        current_app.allow_net_changes = True
+        current_app.range_locks = RangeLocks()
     return app
 
 app = create_app()
 
 @app.route("/lock-acquire", methods=["POST"])
 def acquire_distributed_lock():
-    with current_app.allow_net_changes_cv:
-        current_app.allow_net_changes_cv.wait_for(lambda: current_app.allow_net_changes)
-        current_app.allow_net_changes = False
-    return {"status": "ok"}
+    # {"range": [start, end]} locks an arc of the ring, no range the whole ring
+    data = request.get_json(silent=True) or {}
+    lock_id = current_app.range_locks.acquire(data.get("range", None), data.get("lease", LOCK_LEASE))
+    return {"status": "ok", "lock_id": lock_id}
 
 @app.route("/lock-release", methods=["POST"])
 def release_distributed_lock():
-    with current_app.allow_net_changes_cv:
-        current_app.allow_net_changes = True
-        current_app.allow_net_changes_cv.notify()
+    data = request.get_json(silent=True) or {}
+    if not current_app.range_locks.release(data["lock_id"]):
+        return {"status": "expired"}
     return {"status": "ok"}
 
+@app.route("/lock-renew", methods=["POST"])
+def renew_distributed_lock():
+    data = request.get_json(silent=True) or {}
+    if not current_app.range_locks.renew(data["lock_id"], data.get("lease", LOCK_LEASE)):
+        return {"status": "expired"}
+    return {"status": "ok"}
+
+@app.route("/lock-stats", methods=["POST"])
+def distributed_lock_stats():
+    return current_app.range_locks.stats()
+
 if __name__ == "__main__":
     app.run(port=5001, threaded=True)
-
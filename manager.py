@@ -1,10 +1,13 @@
 import time
 import os
+import shutil
 import tempfile
 import subprocess
 import urllib.parse
 import threading
 import signal
+import uuid
+import traceback
 import psutil
 
 from flask import Flask, request, Response
@@ -24,31 +27,92 @@ HAVE_BOOTSTRAP = True if os.environ["HAVE_BOOTSTRAP"]=="TRUE" else False
 BASE_URL = os.environ["BASE_URL"]
 BOOTSTRAP_URL = os.environ["BOOTSTRAP_URL"]
 LOCKING_SRV_URL = os.environ["LOCKING_SRV_URL"]
+# node-to-node stream transport: worker <id> listens on STREAM_BASE_PORT+<id>
+STREAM_HOST = os.environ.get("STREAM_HOST", urllib.parse.urlsplit(BASE_URL).hostname)
+STREAM_BASE_PORT = int(os.environ.get("STREAM_BASE_PORT", "7000"))
+# log storage backend (STORAGE_BACKEND=log): worker <id> keeps its segment logs under STORAGE_DIR/<id>
+STORAGE_DIR = os.environ.get("STORAGE_DIR", "./storage")
+# bodies are streamed between the client and the worker in pieces of this size
+PROXY_CHUNK_BYTES = int(os.environ.get("PROXY_CHUNK_BYTES", str(64*1024)))
+
+# worker sockets published as WORKER_SOCKET_DIR/<id>.sock symlinks, so that nginx sends /<id>/... straight
+# to the worker (see docker/node/nginx_chordify). The proxy route below stays as the fallback.
+WORKER_SOCKET_DIR = os.environ.get("WORKER_SOCKET_DIR", "./workers")
+
+# a held ring lock is renewed every LOCK_RENEW_INTERVAL seconds, well within its lease (LOCK_LEASE of the locking service)
+LOCK_RENEW_INTERVAL = float(os.environ.get("LOCK_RENEW_INTERVAL", "30"))
+lock_renewals = {} # lock_id -> event that stops the renewal of a lock we hold
+
+# idle workers started ahead of time (gunicorn up, chord imported, not part of the ring yet),
+# claimed by spawn/spawnBootstrap, which then only pay for /init
+WARM_POOL_SIZE = int(os.environ.get("WARM_POOL_SIZE", "2"))
+idle_workers = [] # (process, socket_path)
+idle_lock = threading.Lock()
+pool_refilling = False
+
+HOP_BY_HOP = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+              "te", "trailers", "transfer-encoding", "upgrade"}
+
+def new_worker(proc, socket_path):
+    # one keep-alive session per worker socket, reused by every proxied request to it
+    return {"process": proc, "socket_path": socket_path, "session": requests_unixsocket.Session(),
+            "stats": {"requests": 0, "errors": 0, "upstream_time": 0.0, "max_upstream_time": 0.0,
+                      "total_time": 0.0, "max_total_time": 0.0, "bytes_in": 0, "bytes_out": 0}}
+
+def kill_process(proc):
+    try:
+        parent = psutil.Process(proc.pid)
+        for child in parent.children(recursive=True):
+            child.kill()
+        parent.kill()
+    except psutil.NoSuchProcess:
+        pass
+
+def close_worker(worker_id, worker):
+    unpublish_socket(worker_id, worker["socket_path"])
+    worker["session"].close()
+
+def published_path(worker_id):
+    return os.path.join(WORKER_SOCKET_DIR, f"{worker_id}.sock")
+
+def publish_socket(worker_id, socket_path):
+    if not WORKER_SOCKET_DIR:
+        return
+    link = published_path(worker_id)
+    tmp_link = f"{link}.{os.getpid()}.tmp"
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(os.path.abspath(socket_path), tmp_link)
+    os.replace(tmp_link, link) # atomic: nginx sees the old or the new socket, never none
+
+def unpublish_socket(worker_id, socket_path):
+    # only if it still points to this worker's socket (not to one that replaced it)
+    if not WORKER_SOCKET_DIR:
+        return
+    link = published_path(worker_id)
+    try:
+        if os.readlink(link) == os.path.abspath(socket_path):
+            os.remove(link)
+    except OSError:
+        pass
+
+def reset_published_sockets():
+    # links left behind by a previous run of the manager
+    if not WORKER_SOCKET_DIR:
+        return
+    shutil.rmtree(WORKER_SOCKET_DIR, ignore_errors=True)
+    os.makedirs(WORKER_SOCKET_DIR, exist_ok=True)
 
 def monitor_worker(worker_id, proc):
     proc.wait()
     with workers_lock:
-        workers.pop(worker_id, None)
+        worker = workers.get(worker_id, None)
+        if worker is None or worker["process"] is not proc:
+            return # already replaced (killall)
+        del workers[worker_id]
+    close_worker(worker_id, worker)
 
-def is_bootstrap_alive():
-    resp = requests.post(f"{BOOTSTRAP_URL}/healthcheck", json={})
-    return resp.status_code == 404
-
-@app.route("/management/spawn", methods=["POST"])
-@schemas.validate_json(schemas.SPAWN_SCHEMA)
-def spawn_worker():
-    global next_id
-
-    requests.post(f"{LOCKING_SRV_URL}/lock-acquire", json={})
-
-    if not is_bootstrap_alive():
-        requests.post(f"{LOCKING_SRV_URL}/lock-release", json={})
-        return {"error": "Bootstrap Node is not running."}
-
-    worker_id = next_id
-    next_id += 1
-
-    socket_path = os.path.join(tempfile.gettempdir(), f"worker_{worker_id}.sock")
+def start_process(socket_path):
     if os.path.exists(socket_path):
         os.remove(socket_path)
 
@@ -66,28 +130,184 @@ def spawn_worker():
         "gunicorn_conf.py",
         "chord:app",
     ]
-
-    env = {
-        "IS_BOOTSTRAP": "FALSE",
-        "NODE_URL": f"{BASE_URL}/{worker_id}",
-        "BOOTSTRAP_URL": BOOTSTRAP_URL,
-        "LOCKING_SRV_URL": LOCKING_SRV_URL
-    }
-    proc = subprocess.Popen(cmd, env={**os.environ, **env})
-    workers[worker_id] = {"process": proc, "socket_path": socket_path}
-
-    monitor_thread = threading.Thread(target=monitor_worker, args=(worker_id, proc), daemon=False)
-    monitor_thread.start()
+    # the node settings are sent with /init
+    proc = subprocess.Popen(cmd)
 
     while not os.path.exists(socket_path):
+        if proc.poll() is not None:
+            raise RuntimeError(f"Worker on {socket_path} exited while starting.")
         time.sleep(0.1)
     time.sleep(0.1)
+    return proc
+
+def refill_pool():
+    global pool_refilling
+    with idle_lock:
+        if pool_refilling:
+            return
+        pool_refilling = True
+    try:
+        while True:
+            with idle_lock:
+                idle_workers[:] = [(proc, socket_path) for proc, socket_path in idle_workers if proc.poll() is None]
+                if len(idle_workers) >= WARM_POOL_SIZE:
+                    pool_refilling = False
+                    return
+            socket_path = os.path.join(tempfile.gettempdir(), f"worker_idle_{uuid.uuid4().hex[:12]}.sock")
+            proc = start_process(socket_path)
+            with idle_lock:
+                idle_workers.append((proc, socket_path))
+    except Exception:
+        with idle_lock:
+            pool_refilling = False
+        raise
+
+def claim_process(cold_socket_path):
+    # an idle worker if there is one, else a worker started now
+    claimed = None
+    with idle_lock:
+        while idle_workers and claimed is None:
+            proc, socket_path = idle_workers.pop(0)
+            if proc.poll() is None:
+                claimed = (proc, socket_path)
+    threading.Thread(target=refill_pool, daemon=True).start()
+    if claimed is None:
+        claimed = (start_process(cold_socket_path), cold_socket_path)
+    return claimed
+
+def acquire_lock(arc_of=lambda: None):
+    # arc_of(): arc of the ring to lock (None: the whole ring). It is computed again once the lock is
+    # granted, as a membership change next to it may have moved it meanwhile.
+    while True:
+        arc = arc_of()
+        lock_id = requests.post(f"{LOCKING_SRV_URL}/lock-acquire", json={"range": arc}).json()["lock_id"]
+        if arc_of() == arc:
+            break
+        requests.post(f"{LOCKING_SRV_URL}/lock-release", json={"lock_id": lock_id})
+    stop = threading.Event()
+    lock_renewals[lock_id] = stop
+    threading.Thread(target=renew_lock, args=(lock_id, stop), daemon=True).start()
+    return lock_id
+
+def renew_lock(lock_id, stop):
+    # a join can outlast the lease (large transfers), so the lease is kept alive while we hold the lock
+    while not stop.wait(LOCK_RENEW_INTERVAL):
+        try:
+            status = requests.post(f"{LOCKING_SRV_URL}/lock-renew", json={"lock_id": lock_id}).json()["status"]
+        except Exception:
+            traceback.print_exc()
+            continue
+        if status != "ok":
+            print(f"Lock {lock_id} expired before it could be renewed.", flush=True)
+            return
+
+def release_lock(lock_id):
+    # returns False if the lock had expired: another membership change may have overlapped ours
+    lock_renewals.pop(lock_id).set()
+    return requests.post(f"{LOCKING_SRV_URL}/lock-release", json={"lock_id": lock_id}).json()["status"] == "ok"
+
+def join_arc(node_url):
+    # the nodes a join touches: from the predecessor of the new node to the last replica after it
+    return requests.post(f"{BOOTSTRAP_URL}/joinArc", json={"node_url": node_url}).json()["response"]
 
-    requests.post(f"{BASE_URL}/{worker_id}/init", json={})
+def is_bootstrap_alive():
+    resp = requests.post(f"{BOOTSTRAP_URL}/healthcheck", json={})
+    return resp.status_code == 404
 
-    requests.post(f"{LOCKING_SRV_URL}/lock-release", json={})
+@app.route("/management/spawn", methods=["POST"])
+@schemas.validate_json(schemas.SPAWN_SCHEMA)
+def spawn_worker():
+    global next_id
 
-    return {"id": worker_id}
+    data = request.get_json()
+    count = data.get("count", 1)
+
+    if not is_bootstrap_alive():
+        return {"error": "Bootstrap Node is not running."}
+
+    with workers_lock:
+        worker_ids = list(range(next_id, next_id+count))
+        next_id += count
+
+    # the processes are started (or claimed from the pool) in parallel
+    claimed = {}
+    def claim(worker_id):
+        claimed[worker_id] = claim_process(os.path.join(tempfile.gettempdir(), f"worker_{worker_id}.sock"))
+    claim_threads = [threading.Thread(target=claim, args=(worker_id,)) for worker_id in worker_ids]
+    for thread in claim_threads:
+        thread.start()
+    for thread in claim_threads:
+        thread.join()
+
+    # every claimed process is registered before any join, so that it is tracked (and killed by killall)
+    # whatever happens to the joins
+    configs = {}
+    for worker_id in sorted(claimed):
+        proc, socket_path = claimed[worker_id]
+        configs[worker_id] = {
+            "IS_BOOTSTRAP": "FALSE",
+            "NODE_URL": f"{BASE_URL}/{worker_id}",
+            "NODE_STREAM_ADDR": f"{STREAM_HOST}:{STREAM_BASE_PORT+worker_id}",
+            "STORAGE_DIR": os.path.join(STORAGE_DIR, str(worker_id)),
+            "BOOTSTRAP_URL": BOOTSTRAP_URL,
+            "LOCKING_SRV_URL": LOCKING_SRV_URL
+        }
+        with workers_lock:
+            workers[worker_id] = new_worker(proc, socket_path)
+
+        monitor_thread = threading.Thread(target=monitor_worker, args=(worker_id, proc), daemon=False)
+        monitor_thread.start()
+
+        publish_socket(worker_id, socket_path)
+
+    errors = []
+    if len(claimed) < count:
+        errors.append(f"{count - len(claimed)} worker(s) failed to start.")
+
+    # bulk join: the nodes are admitted one after the other under a single lock over the whole ring, and
+    # the finger tables are rebuilt once at the end, with one walk around the ring.
+    # A single node locks only the arc of the ring it touches; the fingers catch up in the background
+    # (fix_fingers), unless update_fingers asks for the rebuild now (e.g. before a benchmark).
+    bulk = len(configs) > 1 or data.get("update_fingers", False)
+    joined = []
+    if configs:
+        if bulk:
+            lock_id = acquire_lock()
+        else:
+            lock_id = acquire_lock(lambda: join_arc(next(iter(configs.values()))["NODE_URL"]))
+        try:
+            for worker_id, config in configs.items():
+                if init_worker(worker_id, config):
+                    joined.append(worker_id)
+                else:
+                    errors.append(f"Worker {worker_id} failed to join.")
+                    kill_process(claimed[worker_id][0]) # removed from the workers by its monitor
+            if bulk and joined:
+                try:
+                    requests.post(f"{BASE_URL}/{joined[-1]}/updateFingerTablePhase1", json={"initial_url": None, "nodes": None})
+                except requests.RequestException:
+                    traceback.print_exc()
+                    errors.append("The finger tables were not rebuilt; they catch up in the background.")
+        finally:
+            if not release_lock(lock_id):
+                # the nodes have joined, but another membership change may have overlapped ours
+                errors.append("The ring lock expired while the workers were joining.")
+
+    if "count" in data:
+        response = {"ids": joined}
+    else:
+        response = {"id": joined[0]} if joined else {}
+    if errors:
+        response["error"] = " ".join(errors)
+    return response
+
+def init_worker(worker_id, config):
+    try:
+        resp = requests.post(f"{BASE_URL}/{worker_id}/init", json=config)
+        return resp.status_code == 200 and "error" not in resp.json()
+    except (requests.RequestException, ValueError):
+        traceback.print_exc()
+        return False
 
 
 @app.route("/management/spawnBootstrap", methods=["POST"])
@@ -103,47 +323,31 @@ def spawn_bootstrap():
     if 0 in workers:
         return {"error": "Bootstrap node is currently running."}
 
-    requests.post(f"{LOCKING_SRV_URL}/lock-acquire", json={})
+    lock_id = acquire_lock()
 
-    socket_path = os.path.join(tempfile.gettempdir(), "worker_bootstrap.sock")
-    if os.path.exists(socket_path):
-        os.remove(socket_path)
+    proc, socket_path = claim_process(os.path.join(tempfile.gettempdir(), "worker_bootstrap.sock"))
 
-    cmd = [
-        "gunicorn",
-        "-m",
-        "777",
-        "--bind",
-        f"unix:{socket_path}",
-        "--workers",
-        "1",
-        "--worker-class",
-        "gevent",
-        "-c",
-        "gunicorn_conf.py",
-        "chord:app",
-    ]
-
-    env = {
+    config = {
         "IS_BOOTSTRAP": "TRUE",
         "NODE_URL": f"{BASE_URL}/0",
+        "NODE_STREAM_ADDR": f"{STREAM_HOST}:{STREAM_BASE_PORT}",
+        "STORAGE_DIR": os.path.join(STORAGE_DIR, "0"),
         "CONSISTENCY_MODEL": data["consistency_model"],
         "REPLICATION_FACTOR": str(data["replication_factor"]),
+        "TRANSPORT": data.get("transport", "HTTP"),
         "LOCKING_SRV_URL": LOCKING_SRV_URL
     }
-    proc = subprocess.Popen(cmd, env={**os.environ, **env})
-    workers[0] = {"process": proc, "socket_path": socket_path}
+    workers[0] = new_worker(proc, socket_path)
 
     monitor_thread = threading.Thread(target=monitor_worker, args=(0, proc), daemon=False)
     monitor_thread.start()
 
-    while not os.path.exists(socket_path):
-        time.sleep(0.1)
-    time.sleep(0.1)
+    publish_socket(0, socket_path)
 
-    requests.post(f"{BASE_URL}/0/init", json={})
+    requests.post(f"{BASE_URL}/0/init", json=config)
 
-    requests.post(f"{LOCKING_SRV_URL}/lock-release", json={})
+    if not release_lock(lock_id):
+        return {"error": "The ring lock expired while the bootstrap node was starting."}
 
     return {"id": 0}
 
@@ -152,32 +356,61 @@ def spawn_bootstrap():
 def list_workers():
     return list(workers.keys())
 
+@app.route("/management/info", methods=["POST"])
+@schemas.validate_json(schemas.INFO_SCHEMA)
+def info():
+    # lets clients map the node urls of the overlay back to this physical node
+    return {"base_url": BASE_URL}
+
 @app.route("/management/killall", methods=["POST"])
 @schemas.validate_json(schemas.KILLALL_SCHEMA)
 def killall_workers():
     global workers, next_id
-    for _, worker in workers.items():
-        try:
-            parent = psutil.Process(worker["process"].pid)
-            for child in parent.children(recursive=True):
-                child.kill()
-            parent.kill()
-        except psutil.NoSuchProcess:
-            pass
+    for worker_id, worker in workers.items():
+        kill_process(worker["process"])
         if os.path.exists(worker["socket_path"]):
             os.remove(worker["socket_path"])
+        close_worker(worker_id, worker)
     workers = {}
     next_id = 1
     return {}
 
+@app.route("/management/stats", methods=["POST"])
+@schemas.validate_json(schemas.STATS_SCHEMA)
+def proxy_stats():
+    # per worker: time until the worker answered (upstream) and until the whole reply was streamed back (total)
+    stats = {}
+    for worker_id, worker in list(workers.items()):
+        worker_stats = dict(worker["stats"])
+        count = max(worker_stats["requests"], 1)
+        worker_stats["avg_upstream_time"] = worker_stats["upstream_time"] / count
+        worker_stats["avg_total_time"]    = worker_stats["total_time"] / count
+        stats[worker_id] = worker_stats
+    return stats
+
+class BodyStream:
+    # request body of known length, read from the client while it is sent to the worker
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
 @app.route('/<int:worker_id>/', defaults={'path': ''}, methods=["GET", "POST"])
 @app.route('/<int:worker_id>/<path:path>', methods=["GET", "POST"])
 def proxy(worker_id, path):
-    if worker_id not in workers:
-        return {"error": "Worker not found"}
+    worker = workers.get(worker_id, None)
+    if worker is None:
+        return {"error": "Worker not found"}, 503
+
+    t_start = time.monotonic()
+    stats = worker["stats"]
 
-    socket_path = workers[worker_id]["socket_path"]
-    socket_path_enc = urllib.parse.quote(socket_path, safe='')
+    socket_path_enc = urllib.parse.quote(worker["socket_path"], safe='')
 
     query = request.query_string.decode('utf-8')
     target_url = f"http+unix://{socket_path_enc}/{path}"
@@ -185,22 +418,47 @@ def proxy(worker_id, path):
     if query:
         target_url += "?" + query
 
-    session = requests_unixsocket.Session()
-    method = request.method
-    headers = {k: v for k, v in request.headers.items() if k.lower() != "host"}
-    data = request.get_data()
-
-    resp = session.request(
-        method,
-        target_url,
-        headers=headers,
-        data=data,
-        allow_redirects=False
-    )
-
-    response = Response(resp.content, status=resp.status_code)
-    HOP_BY_HOP = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
-                  "te", "trailers", "transfer-encoding", "upgrade"}
+    # the length of the body is set again by requests
+    headers = {k: v for k, v in request.headers.items() if k.lower() not in {"host", "content-length"} | HOP_BY_HOP}
+    length = request.content_length
+    data = BodyStream(request.stream, length) if length else (request.stream if length is None else b"")
+
+    try:
+        resp = worker["session"].request(
+            request.method,
+            target_url,
+            headers=headers,
+            data=data,
+            allow_redirects=False,
+            stream=True
+        )
+    except Exception:
+        stats["errors"] += 1
+        raise
+    t_upstream = time.monotonic() - t_start
+
+    def body():
+        sent, consumed = 0, False
+        try:
+            for chunk in resp.raw.stream(PROXY_CHUNK_BYTES, decode_content=False):
+                sent += len(chunk)
+                yield chunk
+            consumed = True
+        finally:
+            if consumed:
+                resp.raw.release_conn() # back to the worker's pool
+            else:
+                resp.close()
+            t_total = time.monotonic() - t_start
+            stats["requests"] += 1
+            stats["upstream_time"] += t_upstream
+            stats["max_upstream_time"] = max(stats["max_upstream_time"], t_upstream)
+            stats["total_time"] += t_total
+            stats["max_total_time"] = max(stats["max_total_time"], t_total)
+            stats["bytes_in"] += length or 0
+            stats["bytes_out"] += sent
+
+    response = Response(body(), status=resp.status_code)
     for key, value in resp.headers.items():
         if key.lower() not in HOP_BY_HOP:
             response.headers[key] = value
@@ -221,6 +479,16 @@ def cleanup():
                 print(f"Force killing (SIGKILL) subprocess with id {worker_id}...")
                 proc.kill()
 
+    with idle_lock:
+        for proc, socket_path in idle_workers:
+            kill_process(proc)
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+        idle_workers.clear()
+
+reset_published_sockets()
+threading.Thread(target=refill_pool, daemon=True).start()
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, threaded=True)
 
@@ -0,0 +1,92 @@
+import random
+import threading
+import time
+
+
+class Membership:
+    # Eventually consistent view of the ring: url -> {"version", "status", "state"}, where state is the
+    # node's overlay entry. Every node owns its entry and bumps its version (also as a heartbeat);
+    # the tables are spread by push-pull gossip and merged by keeping the higher version per node.
+    #
+    # A node that leaves publishes status "left" (a tombstone, forgotten after tombstone_ttl).
+    # A node whose version has not advanced for `timeout` seconds is left out of the view.
+    def __init__(self, url, timeout=10.0, tombstone_ttl=60.0):
+        self.url = url
+        self.timeout = timeout
+        self.tombstone_ttl = tombstone_ttl
+
+        self.lock = threading.Lock()
+        self.members = {} # url -> entry
+        self.seen    = {} # url -> local time its version last advanced
+        self.version = 0
+
+        self.merges  = 0
+        self.updated = 0
+        self.changes = 0
+
+    def update_self(self, state, status="alive"):
+        with self.lock:
+            # wall clock based, so that a node that restarts with the same url supersedes its old entries
+            self.version = max(self.version + 1, time.time_ns())
+            self.members[self.url] = {"version": self.version, "status": status, "state": state}
+            self.seen[self.url] = time.monotonic()
+
+    def is_live(self, url, now):
+        # caller holds self.lock
+        return self.members[url]["status"] == "alive" and (url == self.url or now - self.seen[url] < self.timeout)
+
+    def live_urls(self):
+        with self.lock:
+            now = time.monotonic()
+            return [url for url in self.members if self.is_live(url, now)]
+
+    def merge(self, members):
+        # returns whether the set of live nodes changed
+        with self.lock:
+            now = time.monotonic()
+            before = {url for url in self.members if self.is_live(url, now)}
+            for url, entry in members.items():
+                if url == self.url:
+                    continue # own entry is authoritative
+                current = self.members.get(url, None)
+                if current is None or entry["version"] > current["version"]:
+                    self.members[url] = entry
+                    self.seen[url] = now
+                    self.updated += 1
+            for url in list(self.members):
+                if url == self.url:
+                    continue
+                age = now - self.seen[url]
+                if (self.members[url]["status"] != "alive" and age > self.tombstone_ttl) or \
+                        age > self.timeout + self.tombstone_ttl:
+                    del self.members[url], self.seen[url]
+            after = {url for url in self.members if self.is_live(url, now)}
+            self.merges += 1
+            if before != after:
+                self.changes += 1
+            return before != after
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.members) # entries are replaced, never modified
+
+    def live_states(self):
+        with self.lock:
+            now = time.monotonic()
+            return [entry["state"] for url, entry in self.members.items() if self.is_live(url, now)]
+
+    def peers(self, fanout):
+        urls = [url for url in self.live_urls() if url != self.url]
+        return random.sample(urls, min(fanout, len(urls)))
+
+    def stats(self):
+        with self.lock:
+            now = time.monotonic()
+            return {
+                "members": len(self.members),
+                "live": sum(self.is_live(url, now) for url in self.members),
+                "version": self.version,
+                "merges": self.merges,
+                "updated": self.updated,
+                "changes": self.changes,
+            }
@@ -19,7 +19,8 @@ def validate_json(schema):
 API_QUERY_SCHEMA = {
     "type": "object",
     "properties": {
-        "key": {"type": "string"}
+        "key": {"type": "string"},
+        "direct": {"type": "boolean"}
     },
     "required": ["key"],
     "additionalProperties": False
@@ -37,6 +38,9 @@ API_MODIFY_SCHEMA = {
         },
         "value": {
             "type": "string"
+        },
+        "direct": {
+            "type": "boolean"
         }
     },
     "required": ["key", "operation"],
@@ -53,7 +57,70 @@ API_MODIFY_SCHEMA = {
     "additionalProperties": False
 }
 
+API_BATCH_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "operations": {
+            "type": "array",
+            "minItems": 1,
+            "maxItems": 10000,
+            "items": {
+                "type": "object",
+                "properties": {
+                    "key": {
+                        "type": "string"
+                    },
+                    "operation": {
+                        "type": "string",
+                        "enum": ["insert", "delete", "query"]
+                    },
+                    "value": {
+                        "type": "string"
+                    }
+                },
+                "required": ["key", "operation"],
+                "allOf": [
+                    {
+                        "if": {"properties": {"operation": {"const": "insert"}}},
+                        "then": {"required": ["value"]}
+                    },
+                    {
+                        "if": {"properties": {"operation": {"const": "query"}}},
+                        "then": {"properties": {"key": {"not": {"const": "*"}}}}
+                    }
+                ],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["operations"],
+    "additionalProperties": False
+}
+
+API_SCAN_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "cursor": {"type": "string"},
+        "page_size": {
+            "type": "integer",
+            "minimum": 1,
+            "maximum": 100000
+        }
+    },
+    "additionalProperties": False
+}
+
 API_OVERLAY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "walk": {
+            "type": "boolean"
+        }
+    },
+    "additionalProperties": False
+}
+
+API_STATS_SCHEMA = {
     "type": "object",
     "properties": {},
     "additionalProperties": False
@@ -67,7 +134,15 @@ API_DEPART_SCHEMA = {
 
 SPAWN_SCHEMA = {
     "type": "object",
-    "properties": {},
+    "properties": {
+        "count": {
+            "type": "integer",
+            "minimum": 1
+        },
+        "update_fingers": {
+            "type": "boolean"
+        }
+    },
     "additionalProperties": False
 }
 
@@ -81,6 +156,10 @@ SPAWN_BOOTSTRAP_SCHEMA = {
         "replication_factor": {
             "type": "integer",
             "minimum": 1
+        },
+        "transport": {
+            "type": "string",
+            "enum": ["HTTP", "STREAM"]
         }
     },
     "required": ["consistency_model", "replication_factor"],
@@ -93,6 +172,18 @@ LIST_WORKERS_SCHEMA = {
     "additionalProperties": False
 }
 
+INFO_SCHEMA = {
+    "type": "object",
+    "properties": {},
+    "additionalProperties": False
+}
+
+STATS_SCHEMA = {
+    "type": "object",
+    "properties": {},
+    "additionalProperties": False
+}
+
 KILLALL_SCHEMA = {
     "type": "object",
     "properties": {},
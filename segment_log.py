@@ -0,0 +1,337 @@
+import mmap
+import os
+import shutil
+import struct
+import threading
+import time
+import traceback
+import weakref
+import zlib
+
+# Append-only log of key/value records, split in segment files, with an in-memory index
+# key -> extents of its value on disk. It is a drop-in for the values dict of a storage.Replica.
+#
+# Record: crc32, key length, value length, kind, key, value.
+# A value that received appends is a list of extents (one PUT and the APPENDs after it),
+# rewritten as one PUT once it has more than APPEND_COMPACT_CHUNKS extents.
+# Sealed segments are read through mmap, the active one with pread.
+#
+# Durability: every record is flushed to the OS when it is written, so it survives a crash of the
+# process. It is only forced to disk (fsync) when a segment is sealed, before compaction removes a
+# segment, and on sync(); STORAGE_FSYNC=always fsyncs every record, to also survive power loss.
+#
+# The files are the node's persistent state: they are only removed by destroy(), when the replica
+# they belong to is dropped.
+
+SEGMENT_BYTES          = int(os.environ.get("STORAGE_SEGMENT_BYTES", str(64*1024*1024)))
+COMPACT_INTERVAL       = float(os.environ.get("STORAGE_COMPACT_INTERVAL", "10"))
+COMPACT_GARBAGE_RATIO  = float(os.environ.get("STORAGE_COMPACT_GARBAGE_RATIO", "0.5"))
+APPEND_COMPACT_CHUNKS  = int(os.environ.get("APPEND_COMPACT_CHUNKS", "64"))
+FSYNC_ALWAYS           = os.environ.get("STORAGE_FSYNC", "roll") == "always"
+
+HEADER = struct.Struct("!IIIB")
+PUT, DELETE, APPEND = 0, 1, 2
+
+open_logs = weakref.WeakSet()
+compactor_lock = threading.Lock()
+compactor_started = False
+
+
+def start_compactor():
+    global compactor_started
+    with compactor_lock:
+        if compactor_started:
+            return
+        compactor_started = True
+    threading.Thread(target=compactor, daemon=True).start()
+
+def compactor():
+    while True:
+        time.sleep(COMPACT_INTERVAL)
+        for log in list(open_logs):
+            try:
+                log.compact()
+            except Exception:
+                traceback.print_exc()
+
+
+class SegmentLog:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+        self.lock = threading.RLock()
+        self.index = {}       # key -> [(segment, value offset, value length, record length)]
+        self.sizes = {}       # segment -> bytes written
+        self.live  = {}       # segment -> bytes of records still referenced by the index
+        self.tombstones = {}  # segment -> {key deleted by it: record length}
+        self.written = {}     # segment -> keys it holds PUT/APPEND records of (live or not)
+        self.maps = {}        # sealed segment -> mmap
+
+        self.compactions = 0
+        self.destroyed = False
+        self.recover()
+
+        open_logs.add(self)
+        start_compactor()
+
+    def segment_path(self, segment):
+        return os.path.join(self.path, f"{segment:08}.log")
+
+    @staticmethod
+    def parse_records(segment, data, offset=0):
+        # (kind, key, extent, record end) of the intact records of a segment's bytes, from offset on.
+        # stops at the first torn (or corrupt) record.
+        while offset + HEADER.size <= len(data):
+            crc, key_len, value_len, kind = HEADER.unpack_from(data, offset)
+            end = offset + HEADER.size + key_len + value_len
+            body = data[offset+HEADER.size:end]
+            if end > len(data) or zlib.crc32(bytes([kind]) + body) != crc:
+                return
+            yield kind, body[:key_len].decode(), (segment, offset + HEADER.size + key_len, value_len, end - offset), end
+            offset = end
+
+    def recover(self):
+        # rebuilds the index by replaying the segments. A torn record at the end of the last segment
+        # (crash in the middle of a write) is cut off.
+        segments = sorted(int(name[:-4]) for name in os.listdir(self.path) if name.endswith(".log"))
+        for segment in segments:
+            self.sizes[segment] = 0
+            self.live[segment]  = 0
+            self.tombstones[segment] = {}
+            self.written[segment] = set()
+            with open(self.segment_path(segment), "rb") as f:
+                data = f.read()
+            offset = 0
+            for kind, key, extent, end in self.parse_records(segment, data):
+                self.apply_record(kind, key, extent)
+                offset = end
+            if offset < len(data):
+                with open(self.segment_path(segment), "r+b") as f:
+                    f.truncate(offset)
+            self.sizes[segment] = offset
+
+        self.active = segments[-1] if segments else 0
+        self.sizes.setdefault(self.active, 0)
+        self.live.setdefault(self.active, 0)
+        self.tombstones.setdefault(self.active, {})
+        self.written.setdefault(self.active, set())
+        self.file = open(self.segment_path(self.active), "a+b")
+        for segment in segments[:-1]:
+            self.map_segment(segment)
+
+    def apply_record(self, kind, key, extent):
+        # caller holds self.lock (or is recovering)
+        segment, _, _, record_len = extent
+        if kind == APPEND and key in self.index:
+            self.index[key].append(extent)
+            self.live[segment] += record_len
+            self.written[segment].add(key)
+            return
+        self.release(self.index.pop(key, []))
+        if kind == DELETE:
+            self.tombstones[segment][key] = record_len
+        else:
+            self.index[key] = [extent]
+            self.live[segment] += record_len
+            self.written[segment].add(key)
+
+    def release(self, extents):
+        for segment, _, _, record_len in extents:
+            self.live[segment] -= record_len
+
+    def map_segment(self, segment):
+        if self.sizes[segment] > 0:
+            with open(self.segment_path(segment), "rb") as f:
+                self.maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def roll(self):
+        # caller holds self.lock
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.map_segment(self.active)
+        self.active += 1
+        self.sizes[self.active] = 0
+        self.live[self.active] = 0
+        self.tombstones[self.active] = {}
+        self.written[self.active] = set()
+        self.file = open(self.segment_path(self.active), "a+b")
+
+    def write(self, kind, key, value):
+        # caller holds self.lock. appends the record and applies it to the index.
+        if self.sizes[self.active] >= SEGMENT_BYTES:
+            self.roll()
+        key_bytes, value_bytes = key.encode(), value.encode()
+        body = key_bytes + value_bytes
+        record = HEADER.pack(zlib.crc32(bytes([kind]) + body), len(key_bytes), len(value_bytes), kind) + body
+        offset = self.sizes[self.active]
+        self.file.write(record)
+        self.file.flush()
+        if FSYNC_ALWAYS:
+            os.fsync(self.file.fileno())
+        self.sizes[self.active] += len(record)
+        self.apply_record(kind, key, (self.active, offset + HEADER.size + len(key_bytes), len(value_bytes), len(record)))
+
+    def read(self, extents):
+        # caller holds self.lock
+        parts = []
+        for segment, offset, length, _ in extents:
+            if segment in self.maps:
+                parts.append(self.maps[segment][offset:offset+length])
+            else:
+                parts.append(os.pread(self.file.fileno(), length, offset))
+        return b"".join(parts).decode()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __getitem__(self, key):
+        with self.lock:
+            return self.read(self.index[key])
+
+    def get(self, key, default=None):
+        with self.lock:
+            extents = self.index.get(key, None)
+            return default if extents is None else self.read(extents)
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.write(PUT, key, value)
+
+    def append(self, key, value):
+        with self.lock:
+            if key not in self.index:
+                return self.write(PUT, key, value)
+            self.write(APPEND, key, value)
+            if len(self.index[key]) > APPEND_COMPACT_CHUNKS:
+                self.write(PUT, key, self.read(self.index[key]))
+
+    def __delitem__(self, key):
+        with self.lock:
+            if key not in self.index:
+                raise KeyError(key)
+            self.write(DELETE, key, "")
+
+    def pop(self, key, *default):
+        with self.lock:
+            if key not in self.index:
+                if default:
+                    return default[0]
+                raise KeyError(key)
+            value = self.read(self.index[key])
+            self.write(DELETE, key, "")
+            return value
+
+    def update(self, other):
+        for key, value in other.items():
+            self[key] = value
+
+    def keys(self):
+        with self.lock:
+            return list(self.index)
+
+    def items(self):
+        for key in self.keys():
+            value = self.get(key, None)
+            if value is not None:
+                yield key, value
+
+    def tombstone_needed(self, segment, key):
+        # caller holds self.lock. A tombstone matters as long as the key is deleted and an older
+        # segment still holds a record of it, which replaying would bring back.
+        return key not in self.index and any(key in self.written[older] for older in self.sizes if older < segment)
+
+    def needed_bytes(self, segment):
+        # caller holds self.lock. live records plus the tombstones that still matter
+        return self.live[segment] + sum(record_len for key, record_len in self.tombstones[segment].items() \
+                if self.tombstone_needed(segment, key))
+
+    def compact(self):
+        # rewrites the live records (and needed tombstones) of sealed segments that are mostly garbage,
+        # then removes them. one key at a time, so that writes go on meanwhile.
+        with self.lock:
+            if self.destroyed:
+                return
+            segments = [segment for segment in self.sizes if segment != self.active and \
+                    self.needed_bytes(segment) < self.sizes[segment] * (1 - COMPACT_GARBAGE_RATIO)]
+        for segment in segments:
+            with self.lock:
+                keys = [key for key, extents in self.index.items() if any(extent[0] == segment for extent in extents)]
+            for key in keys:
+                with self.lock:
+                    if self.destroyed:
+                        return
+                    extents = self.index.get(key, None)
+                    if extents is not None and any(extent[0] == segment for extent in extents):
+                        self.write(PUT, key, self.read(extents))
+            with self.lock:
+                if self.destroyed:
+                    return
+                if self.live[segment] > 0:
+                    continue
+                for key in self.tombstones[segment]:
+                    if self.tombstone_needed(segment, key):
+                        self.write(DELETE, key, "")
+                os.fsync(self.file.fileno()) # the rewritten records are on disk before the old ones go
+                mapped = self.maps.pop(segment, None)
+                if mapped is not None:
+                    mapped.close()
+                os.remove(self.segment_path(segment))
+                del self.sizes[segment], self.live[segment], self.tombstones[segment], self.written[segment]
+                self.compactions += 1
+
+    def position(self):
+        # end of the log: the records written later are the ones keys_since(position) finds
+        with self.lock:
+            return [self.active, self.sizes[self.active]]
+
+    def keys_since(self, position):
+        # keys with a record (of any kind) after position. Compaction only moves records forward,
+        # so a key written after position is found even if its segment was compacted away since.
+        since_segment, since_offset = position
+        keys = set()
+        with self.lock:
+            for segment in sorted(self.sizes):
+                if segment < since_segment:
+                    continue
+                with open(self.segment_path(segment), "rb") as f:
+                    data = f.read(self.sizes[segment])
+                start = since_offset if segment == since_segment else 0
+                keys.update(key for _, key, _, _ in self.parse_records(segment, data, start))
+        return keys
+
+    def sync(self):
+        with self.lock:
+            if not self.destroyed:
+                os.fsync(self.file.fileno())
+
+    def destroy(self):
+        # removes the files: the replica was dropped (its keys moved elsewhere, or are no longer ours)
+        with self.lock:
+            if self.destroyed:
+                return
+            self.destroyed = True
+            self.file.close()
+            for mapped in self.maps.values():
+                mapped.close()
+            self.maps.clear()
+            self.index.clear()
+        open_logs.discard(self)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "path": self.path,
+                "keys": len(self.index),
+                "segments": len(self.sizes),
+                "bytes": sum(self.sizes.values()),
+                "live_bytes": sum(self.live.values()),
+                "compactions": self.compactions,
+            }
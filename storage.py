@@ -0,0 +1,397 @@
+import bisect
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+
+import segment_log
+from segment_log import SegmentLog
+
+# number of small appends kept apart before they are joined into one chunk
+APPEND_COMPACT_CHUNKS = int(os.environ.get("APPEND_COMPACT_CHUNKS", "64"))
+
+# where the values of the replicas live: "dict" (in memory) or "log" (segment logs on disk, one per replica)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "dict")
+STORAGE_DIR     = os.environ.get("STORAGE_DIR", "./storage")
+
+# snapshot a node leaves behind when it departs, to catch up with deltas if it rejoins
+SNAPSHOT_PATH = os.path.join(STORAGE_DIR, "snapshot.json")
+CHANGE_LOG_MAX_ENTRIES = int(os.environ.get("CHANGE_LOG_MAX_ENTRIES", "100000"))
+
+
+def configure(storage_dir):
+    # set at /init: workers are started before they know which node they will be
+    global STORAGE_DIR, SNAPSHOT_PATH
+    STORAGE_DIR   = storage_dir
+    SNAPSHOT_PATH = os.path.join(STORAGE_DIR, "snapshot.json")
+    remove_orphans()
+
+def remove_orphans():
+    # The logs a snapshot (of a departure, or the last checkpoint before a crash) refers to are reopened
+    # and replayed by load_snapshot. Any other log under STORAGE_DIR belonged to a replica that had been
+    # dropped (or created after the snapshot, which cannot be caught up with a delta): it is removed.
+    if not os.path.isdir(STORAGE_DIR):
+        return
+    try:
+        with open(SNAPSHOT_PATH) as f:
+            kept = {os.path.abspath(path) for path in json.load(f)["replicas"]}
+    except (OSError, ValueError, KeyError):
+        return # without a snapshot to tell which logs are live, nothing is removed
+    kept |= {os.path.abspath(log.path) for log in list(segment_log.open_logs)}
+    for name in os.listdir(STORAGE_DIR):
+        path = os.path.join(STORAGE_DIR, name)
+        if is_log_dir(name) and os.path.isdir(path) and os.path.abspath(path) not in kept:
+            print(f"Removing orphaned replica log {path}", flush=True)
+            shutil.rmtree(path, ignore_errors=True)
+
+def is_log_dir(name):
+    # the directories of new_store(): uuid4 hex names
+    try:
+        return len(name) == 32 and uuid.UUID(hex=name).hex == name
+    except ValueError:
+        return False
+
+
+def hash_id(value):
+    return int.from_bytes( hashlib.sha1(value.encode()).digest(), byteorder="little")
+
+
+class AppendValue:
+    # Value of a key that received appends (insert concatenates). Appends go to a list and are only
+    # joined every APPEND_COMPACT_CHUNKS appends, and the whole value is joined (once) when it is read,
+    # so n appends cost O(total length) instead of O(n * length).
+    __slots__ = ("chunks", "tail")
+    lock = threading.Lock() # appends (writer) vs joins on read (any handler)
+
+    def __init__(self, first):
+        self.chunks = [first]
+        self.tail   = []
+
+    def append(self, value):
+        with AppendValue.lock:
+            self.tail.append(value)
+            if len(self.tail) >= APPEND_COMPACT_CHUNKS:
+                self.chunks.append("".join(self.tail))
+                self.tail = []
+
+    def materialize(self):
+        with AppendValue.lock:
+            if len(self.chunks) > 1 or self.tail:
+                self.chunks = ["".join(self.chunks) + "".join(self.tail)]
+                self.tail   = []
+            return self.chunks[0]
+
+
+def materialize(value):
+    return value.materialize() if isinstance(value, AppendValue) else value
+
+
+def new_store(durable):
+    # only the replicas a node serves from (durable) go to a log. Copies in transit stay in memory.
+    if durable and STORAGE_BACKEND == "log":
+        return SegmentLog(os.path.join(STORAGE_DIR, uuid.uuid4().hex))
+    return {}
+
+
+class Replica:
+    # A replica (data_store[i]) of a key range.
+    # Besides the key -> value dict, it keeps the keys ordered by their (cached) hash, so that
+    # the keys of a ring range are found with a bisect and moved as a slice, instead of
+    # re-hashing and filtering every key on each join/depart.
+    def __init__(self, items=None, durable=False):
+        self.values = new_store(durable)
+        self.hashes = {}       # key -> hash, computed once per key
+        self.order_hashes = [] # sorted hashes
+        self.order_keys   = [] # keys, in the order of order_hashes
+
+        if items:
+            pairs = items.items() if isinstance(items, dict) else items
+            for key, value in pairs:
+                self.values[key] = value
+            ordered = sorted((hash_id(key), key) for key in self.values)
+            self.hashes       = {key: key_hash for key_hash, key in ordered}
+            self.order_hashes = [key_hash for key_hash, _ in ordered]
+            self.order_keys   = [key for _, key in ordered]
+
+    @classmethod
+    def load(cls, path):
+        # reopens the segment log of a replica (e.g. after a restart). only the keys are hashed again.
+        replica = cls()
+        replica.values = SegmentLog(path)
+        ordered = sorted((hash_id(key), key) for key in replica.values.keys())
+        replica.hashes       = {key: key_hash for key_hash, key in ordered}
+        replica.order_hashes = [key_hash for key_hash, _ in ordered]
+        replica.order_keys   = [key for _, key in ordered]
+        return replica
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def __getitem__(self, key):
+        return materialize(self.values[key])
+
+    def get(self, key, default=None):
+        return materialize(self.values.get(key, default))
+
+    def __setitem__(self, key, value):
+        if key not in self.values:
+            key_hash = hash_id(key)
+            idx = bisect.bisect_left(self.order_hashes, key_hash)
+            self.order_hashes.insert(idx, key_hash)
+            self.order_keys.insert(idx, key)
+            self.hashes[key] = key_hash
+        self.values[key] = value
+
+    def append(self, key, value):
+        # insert: concatenates to the current value
+        if key not in self.values:
+            self[key] = value
+            return
+        if not isinstance(self.values, dict):
+            self.values.append(key, value) # appended in the log
+            return
+        current = self.values[key]
+        if isinstance(current, AppendValue):
+            current.append(value)
+        else:
+            appended = AppendValue(current)
+            appended.append(value)
+            self.values[key] = appended
+
+    def pop(self, key, default=None):
+        if key not in self.values:
+            return default
+        key_hash = self.hashes.pop(key)
+        idx = bisect.bisect_left(self.order_hashes, key_hash)
+        while self.order_keys[idx] != key: # hash collision (practically never)
+            idx += 1
+        del self.order_hashes[idx]
+        del self.order_keys[idx]
+        return materialize(self.values.pop(key))
+
+    def keys(self):
+        return iter(self.order_keys)
+
+    def items(self):
+        # in hash order
+        return self.slices_items([(0, len(self.order_keys))])
+
+    def stats(self):
+        return self.values.stats() if not isinstance(self.values, dict) else {"keys": len(self.values)}
+
+    def destroy(self):
+        # the replica is dropped: its log (if any) is removed from disk
+        if not isinstance(self.values, dict):
+            self.values.destroy()
+
+    def to_dict(self):
+        return {key: materialize(value) for key, value in self.values.items()}
+
+    def slices_items(self, slices):
+        for lo, hi in slices:
+            for key in self.order_keys[lo:hi]:
+                value = self.values.get(key) # might have been deleted meanwhile
+                if value is not None:
+                    yield key, materialize(value)
+
+    def page_after(self, after_hash, limit):
+        # up to `limit` (hash, key, value) entries with hash > after_hash (None: from the start), in hash order
+        lo = 0 if after_hash is None else bisect.bisect_right(self.order_hashes, after_hash)
+        return [(self.order_hashes[i], self.order_keys[i], self[self.order_keys[i]])
+                for i in range(lo, min(lo + limit, len(self.order_keys)))]
+
+    def range_items(self, start, end):
+        # in hash order, without copying the range
+        return self.slices_items(self.range_slices(start, end))
+
+    def outside_items(self, start, end):
+        return self.slices_items(self.complement_slices(self.range_slices(start, end)))
+
+    def range_slices(self, start, end):
+        # index slices of order_keys lying in the ring range [start, end] (see ChordNode.lies_in_range)
+        n = len(self.order_hashes)
+        if start == end:
+            return [(0, n)]
+        lo = bisect.bisect_left(self.order_hashes, start)
+        hi = bisect.bisect_right(self.order_hashes, end)
+        if start <= end:
+            return [(lo, max(lo, hi))]
+        return [(0, hi), (lo, n)] # wraps around 0. kept in hash order.
+
+    def complement_slices(self, slices):
+        n = len(self.order_hashes)
+        result, prev = [], 0
+        for lo, hi in slices:
+            if lo > prev:
+                result.append((prev, lo))
+            prev = max(prev, hi)
+        if prev < n:
+            result.append((prev, n))
+        return result
+
+    def copy_slices(self, slices, durable=False):
+        copy = Replica(durable=durable)
+        for lo, hi in slices:
+            copy.order_hashes += self.order_hashes[lo:hi]
+            copy.order_keys   += self.order_keys[lo:hi]
+        copy.hashes = dict(zip(copy.order_keys, copy.order_hashes))
+        # one value at a time, so that a range moved between logs is never held in memory as a whole.
+        # appended values are joined, so that the copy does not share them
+        for key in copy.order_keys:
+            copy.values[key] = self[key]
+        return copy
+
+    def extract_slices(self, slices):
+        # the extracted keys stay a replica of this node (one unit of distance further)
+        extracted = self.copy_slices(slices, durable=not isinstance(self.values, dict))
+        for key in extracted.order_keys:
+            del self.values[key]
+            del self.hashes[key]
+        for lo, hi in sorted(slices, reverse=True):
+            del self.order_hashes[lo:hi]
+            del self.order_keys[lo:hi]
+        return extracted
+
+    def copy_range(self, start, end):
+        return self.copy_slices(self.range_slices(start, end))
+
+    def copy_outside(self, start, end):
+        return self.copy_slices(self.complement_slices(self.range_slices(start, end)))
+
+    def extract_range(self, start, end):
+        # removes (and returns) the keys in the ring range [start, end]
+        return self.extract_slices(self.range_slices(start, end))
+
+    def extract_outside(self, start, end):
+        # removes (and returns) the keys outside the ring range [start, end]
+        return self.extract_slices(self.complement_slices(self.range_slices(start, end)))
+
+    def update(self, other):
+        if len(other) * 8 < len(self):
+            for key, value in other.items():
+                self[key] = value
+            return
+        # merge the two hash orders (timsort merges the two sorted runs in linear time)
+        merged = sorted(list(zip(self.order_hashes, self.order_keys)) + list(zip(other.order_hashes, other.order_keys)))
+        for key, value in other.items():
+            self.values[key] = value
+        self.order_hashes, self.order_keys = [], []
+        for key_hash, key in merged:
+            if self.order_keys and self.order_keys[-1] == key:
+                continue # key present in both
+            self.order_hashes.append(key_hash)
+            self.order_keys.append(key)
+        self.hashes = dict(zip(self.order_keys, self.order_hashes))
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+
+class ChangeLog:
+    # Keys modified at this node, in modification order, bounded to the most recent max_entries keys.
+    # A departing predecessor takes a marker (log id, sequence number). If it rejoins, only the keys
+    # changed after the marker are sent to it. The log is reset (new id) when the layout of the
+    # replicas changes for any other reason, as the marker no longer matches what a rejoin receives.
+    def __init__(self, max_entries=CHANGE_LOG_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.resets = 0
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.log_id  = uuid.uuid4().hex
+            self.seq     = 0
+            self.entries = OrderedDict() # key -> seq of its last change, oldest first
+            self.max_evicted = 0         # newest seq that fell out of the log
+            self.resets += 1
+
+    def record(self, key):
+        with self.lock:
+            self.seq += 1
+            self.entries.pop(key, None)
+            self.entries[key] = self.seq
+            if len(self.entries) > self.max_entries:
+                self.max_evicted = self.entries.popitem(last=False)[1]
+
+    def marker(self):
+        with self.lock:
+            return {"log_id": self.log_id, "seq": self.seq}
+
+    def since(self, marker):
+        # keys changed after the marker, or None if the log cannot tell (reset or truncated since)
+        with self.lock:
+            if marker["log_id"] != self.log_id or self.max_evicted > marker["seq"]:
+                return None
+            changed = []
+            for key in reversed(self.entries):
+                if self.entries[key] <= marker["seq"]:
+                    break
+                changed.append(key)
+            return changed
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "seq": self.seq, "resets": self.resets}
+
+
+def log_positions(replicas):
+    # (path, end of the log) of every replica of the log backend
+    return [(replica.values.path, replica.values.position()) for replica in replicas]
+
+def save_snapshot(replicas, marker, positions=None):
+    # log backend: the snapshot refers to the logs of the replicas, which are kept on disk.
+    # positions: where the logs were when everything before was known to the successor (checkpoints).
+    # The keys written after it are caught up on rejoin along with the ones of the marker. None: at the end.
+    # dict backend: the items are written out.
+    os.makedirs(STORAGE_DIR, exist_ok=True)
+    snapshot = {"marker": marker, "backend": STORAGE_BACKEND, "replicas": []}
+    if STORAGE_BACKEND == "log":
+        snapshot["positions"] = positions if positions is not None else [position for _, position in log_positions(replicas)]
+    for i, replica in enumerate(replicas):
+        if isinstance(replica.values, dict):
+            path = os.path.join(STORAGE_DIR, f"snapshot_{i}.json")
+            with open(path, "w") as f:
+                json.dump(list(replica.items()), f)
+        else:
+            replica.values.sync()
+            path = replica.values.path
+        snapshot["replicas"].append(path)
+    with open(SNAPSHOT_PATH + ".tmp", "w") as f:
+        json.dump(snapshot, f)
+    os.replace(SNAPSHOT_PATH + ".tmp", SNAPSHOT_PATH)
+
+def load_snapshot():
+    # returns (marker, replicas) or None. The snapshot is consumed: a later departure (or checkpoint) writes a new one.
+    # log backend: the marker also lists the keys written after the positions of the snapshot ("suspects"),
+    # which the successor sends again on rejoin.
+    if not os.path.exists(SNAPSHOT_PATH):
+        return None
+    try:
+        with open(SNAPSHOT_PATH) as f:
+            snapshot = json.load(f)
+        if snapshot["backend"] != STORAGE_BACKEND:
+            return None
+        if STORAGE_BACKEND == "log" and not all(os.path.isdir(path) for path in snapshot["replicas"]):
+            return None
+        replicas, suspects = [], set()
+        for i, path in enumerate(snapshot["replicas"]):
+            if STORAGE_BACKEND == "log":
+                replicas.append(Replica.load(path)) # destroyed by the caller if it is not used
+                suspects |= replicas[-1].values.keys_since(snapshot["positions"][i])
+            else:
+                with open(path) as f:
+                    replicas.append(Replica(json.load(f)))
+                os.remove(path)
+        return {**snapshot["marker"], "suspects": sorted(suspects)}, replicas
+    except (OSError, ValueError, KeyError):
+        return None
+    finally:
+        os.remove(SNAPSHOT_PATH)
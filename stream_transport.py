@@ -0,0 +1,190 @@
+import json
+import socket
+import struct
+import threading
+import traceback
+from collections import deque
+
+# Node-to-node transport for ring neighbours: one long-lived TCP connection per successor,
+# carrying length-prefixed JSON frames {"endpoint": ..., "data": ...}.
+# A single connection is a FIFO channel, which is exactly what chain replication assumes,
+# so frames are delivered (and handled) in the order they were submitted.
+
+HEADER = struct.Struct("!I")
+
+def encode_frame(endpoint, data):
+    payload = json.dumps({"endpoint": endpoint, "data": data}).encode()
+    return HEADER.pack(len(payload)) + payload
+
+def recv_exactly(conn, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = conn.recv(size - len(buf))
+        if not chunk:
+            return None
+        buf += chunk
+    return bytes(buf)
+
+def parse_addr(addr):
+    host, port = addr.rsplit(":", 1)
+    return host, int(port)
+
+
+class StreamServer:
+    # The frames skip the HTTP front (and its authentication), so the server listens only on the host of
+    # its configured address, and allow_peer(ip) decides which peers may connect (the nodes of the ring).
+    def __init__(self, addr, on_message, allow_peer=None):
+        self.addr = addr
+        self.on_message = on_message
+        self.allow_peer = allow_peer
+        self.frames_received = 0
+        self.connections = 0
+        self.rejected = 0
+
+    def start(self):
+        host, port = parse_addr(self.addr)
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.listener.bind((host, port))
+        except OSError:
+            # the host is not an address of this machine (e.g. behind NAT): all interfaces,
+            # and only allow_peer keeps strangers out
+            print(f"Cannot listen on {host}, listening for streams on all interfaces.", flush=True)
+            self.listener.bind(("0.0.0.0", port))
+        self.listener.listen()
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def accept_loop(self):
+        while True:
+            conn, (peer_ip, _) = self.listener.accept()
+            if self.allow_peer is not None and not self.allow_peer(peer_ip):
+                self.rejected += 1
+                conn.close()
+                continue
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connections += 1
+            threading.Thread(target=self.serve_connection, args=(conn,), daemon=True).start()
+
+    def serve_connection(self, conn):
+        # frames of one connection are handled sequentially, preserving FIFO order.
+        with conn:
+            while True:
+                header = recv_exactly(conn, HEADER.size)
+                if header is None:
+                    return
+                payload = recv_exactly(conn, HEADER.unpack(header)[0])
+                if payload is None:
+                    return
+                self.frames_received += 1
+                message = json.loads(payload)
+                try:
+                    self.on_message(message["endpoint"], message["data"])
+                except Exception:
+                    traceback.print_exc()
+
+    def stats(self):
+        return {"connections_accepted": self.connections, "connections_rejected": self.rejected,
+                "frames_received": self.frames_received}
+
+
+class StreamSender:
+    # Frames are written in batches. If the connection breaks, the whole batch is written again on a new
+    # connection: the peer drops a half-received frame with the old connection and discards the frames it
+    # already handled by their sequence number. If the peer stays unreachable, the sender fails and hands
+    # every frame it still holds to on_failure, so that the caller can send them another way.
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, url, addr, on_failure=None):
+        self.url  = url  # node url of the peer, to detect successor changes
+        self.addr = addr
+        self.on_failure = on_failure
+
+        self.cv = threading.Condition()
+        self.queue = deque() # (endpoint, data)
+        self.writing = False
+        self.closed = False
+        self.failed = False
+        self.conn = None
+
+        self.frames_sent = 0
+        self.reconnects = 0
+
+        threading.Thread(target=self.writer, daemon=True).start()
+
+    def submit(self, endpoint, data):
+        # returns False if the sender has failed. The frame was not queued then.
+        with self.cv:
+            if self.failed:
+                return False
+            self.queue.append((endpoint, data))
+            self.cv.notify()
+            return True
+
+    def connect(self):
+        self.conn = socket.create_connection(parse_addr(self.addr))
+        self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def write(self, frames):
+        for attempt in range(self.MAX_ATTEMPTS):
+            try:
+                if self.conn is None:
+                    self.connect()
+                self.conn.sendall(frames)
+                return True
+            except OSError:
+                traceback.print_exc()
+                if self.conn is not None:
+                    self.conn.close()
+                    self.conn = None
+                self.reconnects += 1
+        return False
+
+    def writer(self):
+        while True:
+            with self.cv:
+                self.cv.wait_for(lambda: len(self.queue) > 0 or self.closed)
+                if self.closed and len(self.queue) == 0:
+                    break
+                batch = list(self.queue)
+                self.queue.clear()
+                self.writing = True
+
+            # write every queued frame with one syscall
+            if self.write(b"".join(encode_frame(endpoint, data) for endpoint, data in batch)):
+                self.frames_sent += len(batch)
+                with self.cv:
+                    self.writing = False
+                    self.cv.notify_all()
+                continue
+
+            with self.cv:
+                self.failed = True
+                unsent = batch + list(self.queue)
+                self.queue.clear()
+                self.writing = False
+                self.cv.notify_all()
+            print(f"Stream to {self.addr} failed, {len(unsent)} frames not sent.", flush=True)
+            if self.on_failure is not None:
+                try:
+                    self.on_failure(self, unsent)
+                except Exception:
+                    traceback.print_exc()
+            break
+
+        if self.conn is not None:
+            self.conn.close()
+
+    def pending(self):
+        with self.cv:
+            return len(self.queue) + (1 if self.writing else 0)
+
+    def close(self):
+        # remaining frames are flushed before the connection is closed.
+        with self.cv:
+            self.closed = True
+            self.cv.notify_all()
+
+    def stats(self):
+        return {"peer": self.url, "frames_sent": self.frames_sent, "reconnects": self.reconnects,
+                "queued": self.pending(), "failed": self.failed}
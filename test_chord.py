@@ -0,0 +1,84 @@
+import pytest
+
+pytest.importorskip("flask")
+
+from chord import ChordNode
+from storage import ChangeLog, Replica, hash_id
+
+RING = 2**160
+
+
+def make_node(keys_start, keys_end, replication_factor=2):
+    # only the state rejoin_delta looks at
+    node = ChordNode.__new__(ChordNode)
+    node.replication_factor = replication_factor
+    node.max_replication_factor = replication_factor
+    node.keys_start = keys_start
+    node.keys_end = keys_end
+    node.change_log = ChangeLog()
+    node.data_store = [Replica() for _ in range(replication_factor)]
+    return node
+
+@pytest.fixture
+def ring():
+    # this node serves [RING/4, RING-1], the rejoining node takes back [RING/4, RING/2].
+    # keys below RING/4 belong to the predecessors, of which this node holds replica 1.
+    node = make_node(RING // 4, RING - 1)
+    keys = {"rejoined": [], "ours": [], "replica": []}
+    for i in range(200):
+        key = f"k{i}"
+        key_hash = hash_id(key)
+        if key_hash < RING // 4:
+            keys["replica"].append(key)
+            node.data_store[1][key] = "old"
+        elif key_hash <= RING // 2:
+            keys["rejoined"].append(key)
+            node.data_store[0][key] = "old"
+        else:
+            keys["ours"].append(key)
+            node.data_store[0][key] = "old"
+    return node, keys, RING // 2
+
+def modify(node, replica, key, value):
+    if value is None:
+        node.data_store[replica].pop(key)
+    else:
+        node.data_store[replica][key] = value
+    node.change_log.record(key)
+
+
+def test_rejoin_delta_only_changes_since_departure(ring):
+    node, keys, new_node_id = ring
+    modify(node, 0, keys["rejoined"][0], "before")
+    snapshot = {**node.change_log.marker(), "replicas": 2}
+
+    modify(node, 0, keys["rejoined"][1], "new")
+    modify(node, 0, keys["rejoined"][2], None)
+    modify(node, 0, keys["ours"][0], "new")
+    modify(node, 1, keys["replica"][0], "new")
+    modify(node, 1, keys["replica"][1], None)
+
+    upserts, deleted = node.rejoin_delta(new_node_id, snapshot)
+    assert upserts == [[(keys["rejoined"][1], "new")], [(keys["replica"][0], "new")]]
+    assert sorted(deleted[0]) == [keys["rejoined"][2]]
+    assert sorted(deleted[1]) == [keys["replica"][1]]
+
+def test_rejoin_delta_sends_suspects_again(ring):
+    node, keys, new_node_id = ring
+    snapshot = {**node.change_log.marker(), "replicas": 2, "suspects": [keys["rejoined"][0], keys["ours"][0]]}
+    upserts, deleted = node.rejoin_delta(new_node_id, snapshot)
+    assert upserts == [[(keys["rejoined"][0], "old")], []]
+    assert deleted == [[], []]
+
+def test_rejoin_delta_falls_back_to_full_transfer(ring):
+    node, keys, new_node_id = ring
+    snapshot = {**node.change_log.marker(), "replicas": 2}
+    assert node.rejoin_delta(new_node_id, None) is None
+    assert node.rejoin_delta(new_node_id, {**snapshot, "replicas": 3}) is None
+    node.change_log.reset()
+    assert node.rejoin_delta(new_node_id, snapshot) is None
+
+def test_rejoin_delta_while_replication_grows(ring):
+    node, keys, new_node_id = ring
+    node.max_replication_factor = 3
+    assert node.rejoin_delta(new_node_id, {**node.change_log.marker(), "replicas": 2}) is None
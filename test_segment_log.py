@@ -0,0 +1,171 @@
+import os
+
+import pytest
+
+import segment_log
+from segment_log import SegmentLog
+
+
+@pytest.fixture
+def log_path(tmp_path):
+    return str(tmp_path / "log")
+
+def crash(log):
+    # drops the log as a crashed process would: no sync, no destroy
+    with log.lock:
+        log.file.close()
+        for mapped in log.maps.values():
+            mapped.close()
+        log.maps.clear()
+    segment_log.open_logs.discard(log)
+
+def roll(log):
+    with log.lock:
+        log.roll()
+
+
+def test_recover_replays_puts_appends_and_deletes(log_path):
+    log = SegmentLog(log_path)
+    log["a"] = "1"
+    log["b"] = "2"
+    log.append("b", "3")
+    log["c"] = "4"
+    del log["c"]
+    roll(log)
+    log["a"] = "5"
+    crash(log)
+
+    log = SegmentLog(log_path)
+    assert sorted(log.keys()) == ["a", "b"]
+    assert log["a"] == "5"
+    assert log["b"] == "23"
+    assert "c" not in log
+    log.destroy()
+
+def test_recover_truncates_torn_record(log_path):
+    log = SegmentLog(log_path)
+    log["a"] = "1"
+    log["b"] = "2"
+    segment = log.segment_path(log.active)
+    size = log.sizes[log.active]
+    crash(log)
+    with open(segment, "ab") as f:
+        f.write(segment_log.HEADER.pack(0, 1, 100, segment_log.PUT) + b"cxx") # crash in the middle of a write
+
+    log = SegmentLog(log_path)
+    assert sorted(log.keys()) == ["a", "b"]
+    assert os.path.getsize(segment) == size
+    log["c"] = "3" # appended right after the last intact record
+    crash(log)
+
+    log = SegmentLog(log_path)
+    assert dict(log.items()) == {"a": "1", "b": "2", "c": "3"}
+    log.destroy()
+
+def test_recover_stops_at_corrupt_record(log_path):
+    log = SegmentLog(log_path)
+    log["a"] = "1"
+    log["b"] = "2"
+    segment = log.segment_path(log.active)
+    crash(log)
+    with open(segment, "r+b") as f:
+        f.seek(-1, os.SEEK_END)
+        f.write(b"x")
+
+    log = SegmentLog(log_path)
+    assert log.keys() == ["a"]
+    log.destroy()
+
+def test_append_is_rewritten_after_many_chunks(log_path, monkeypatch):
+    monkeypatch.setattr(segment_log, "APPEND_COMPACT_CHUNKS", 4)
+    log = SegmentLog(log_path)
+    log["a"] = "x"
+    for _ in range(10):
+        log.append("a", "y")
+    assert log["a"] == "x" + "y" * 10
+    assert len(log.index["a"]) <= 5
+    log.destroy()
+
+def test_compact_rewrites_live_records(log_path):
+    log = SegmentLog(log_path)
+    for i in range(10):
+        log[f"k{i}"] = "old"
+    roll(log)
+    for i in range(9):
+        log[f"k{i}"] = "new"
+    roll(log)
+
+    log.compact()
+    assert log.compactions == 1
+    assert 0 not in log.sizes
+    assert dict(log.items()) == {**{f"k{i}": "new" for i in range(9)}, "k9": "old"}
+    crash(log)
+
+    log = SegmentLog(log_path)
+    assert dict(log.items()) == {**{f"k{i}": "new" for i in range(9)}, "k9": "old"}
+    log.destroy()
+
+def test_compact_keeps_needed_tombstone(log_path):
+    log = SegmentLog(log_path)
+    log["a"] = "1"
+    log["b"] = "2" * 100
+    roll(log)
+    del log["a"] # needed: segment 0 still holds a record of "a"
+    log["c"] = "3"
+    del log["c"] # not needed: "c" was only ever written in this segment
+    roll(log)
+
+    log.compact()
+    assert 1 not in log.sizes
+    assert 0 in log.sizes # mostly live
+    assert list(log.tombstones[log.active]) == ["a"]
+    crash(log)
+
+    log = SegmentLog(log_path)
+    assert dict(log.items()) == {"b": "2" * 100}
+    log.destroy()
+
+def test_compact_drops_tombstone_once_older_records_are_gone(log_path):
+    log = SegmentLog(log_path)
+    log["a"] = "1"
+    roll(log)
+    del log["a"]
+    roll(log)
+
+    log.compact()
+    assert 0 not in log.sizes
+    assert 1 in log.sizes # the tombstone still mattered when the segments were picked
+
+    log.compact()
+    assert sorted(log.sizes) == [log.active]
+    assert log.tombstones[log.active] == {}
+    assert log.sizes[log.active] == 0
+
+    # nothing left to rewrite: the tombstone does not go around again
+    log.compact()
+    assert log.compactions == 2
+    crash(log)
+
+    log = SegmentLog(log_path)
+    assert len(log) == 0
+    log.destroy()
+
+def test_keys_since_position(log_path):
+    log = SegmentLog(log_path)
+    log["a"] = "1"
+    position = log.position()
+    log["b"] = "2"
+    roll(log)
+    del log["a"]
+    assert log.keys_since(position) == {"a", "b"}
+    assert log.keys_since(log.position()) == set()
+    log.destroy()
+
+def test_destroy_removes_files(log_path):
+    log = SegmentLog(log_path)
+    log["a"] = "1"
+    roll(log)
+    log.destroy()
+    assert not os.path.exists(log_path)
+    assert log not in segment_log.open_logs
+    log.compact() # no-op once destroyed
@@ -0,0 +1,138 @@
+import os
+import uuid
+
+import pytest
+
+import segment_log
+import storage
+from storage import ChangeLog, Replica
+
+
+@pytest.fixture
+def storage_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "STORAGE_DIR", str(tmp_path))
+    monkeypatch.setattr(storage, "SNAPSHOT_PATH", str(tmp_path / "snapshot.json"))
+    return tmp_path
+
+@pytest.fixture
+def log_backend(storage_dir, monkeypatch):
+    monkeypatch.setattr(storage, "STORAGE_BACKEND", "log")
+    return storage_dir
+
+def crash(replica):
+    # drops the log of a replica as a crashed process would
+    log = replica.values
+    with log.lock:
+        log.file.close()
+        for mapped in log.maps.values():
+            mapped.close()
+        log.maps.clear()
+    segment_log.open_logs.discard(log)
+
+
+def test_change_log_since_marker():
+    log = ChangeLog()
+    log.record("a")
+    marker = log.marker()
+    log.record("b")
+    log.record("c")
+    log.record("b")
+    assert sorted(log.since(marker)) == ["b", "c"]
+    assert log.since(log.marker()) == []
+
+def test_change_log_reset_invalidates_marker():
+    log = ChangeLog()
+    marker = log.marker()
+    log.record("a")
+    log.reset()
+    assert log.since(marker) is None
+
+def test_change_log_truncated_past_marker():
+    log = ChangeLog(max_entries=2)
+    log.record("a")
+    marker = log.marker()
+    log.record("b")
+    log.record("c")
+    assert log.since(marker) == ["c", "b"]
+    log.record("d") # "b", changed after the marker, falls out
+    assert log.since(marker) is None
+
+def test_change_log_rewrite_keeps_marker():
+    # keys rewritten over and over do not push older changes out
+    log = ChangeLog(max_entries=2)
+    marker = log.marker()
+    for _ in range(10):
+        log.record("a")
+    assert log.since(marker) == ["a"]
+
+
+def test_replica_ranges():
+    replica = Replica({f"k{i}": str(i) for i in range(50)})
+    start, end = sorted(replica.order_hashes)[10], sorted(replica.order_hashes)[30]
+    inside = dict(replica.range_items(start, end))
+    outside = dict(replica.outside_items(start, end))
+    assert len(inside) == 21 and len(outside) == 29
+    assert {**inside, **outside} == replica.to_dict()
+
+    extracted = replica.extract_range(start, end)
+    assert extracted.to_dict() == inside
+    assert replica.to_dict() == outside
+    replica |= extracted
+    assert len(replica) == 50
+    assert replica.order_hashes == sorted(replica.order_hashes)
+
+
+def test_snapshot_dict_backend(storage_dir):
+    replicas = [Replica({"a": "1"}), Replica({"b": "2"})]
+    storage.save_snapshot(replicas, {"log_id": "x", "seq": 3})
+    marker, loaded = storage.load_snapshot()
+    assert marker == {"log_id": "x", "seq": 3, "suspects": []}
+    assert [replica.to_dict() for replica in loaded] == [{"a": "1"}, {"b": "2"}]
+    assert storage.load_snapshot() is None # consumed
+
+def test_snapshot_log_backend_suspects(log_backend):
+    replicas = [Replica(durable=True), Replica(durable=True)]
+    replicas[0]["a"] = "1"
+    replicas[1]["b"] = "2"
+    positions = [position for _, position in storage.log_positions(replicas)]
+    # written after the checkpoint: the successor may not have them
+    replicas[0]["c"] = "3"
+    replicas[1].pop("b")
+    storage.save_snapshot(replicas, {"log_id": "x", "seq": 3}, positions)
+    for replica in replicas:
+        crash(replica)
+
+    marker, loaded = storage.load_snapshot()
+    assert marker["suspects"] == ["b", "c"]
+    assert [replica.to_dict() for replica in loaded] == [{"a": "1", "c": "3"}, {}]
+    for replica in loaded:
+        replica.destroy()
+
+def test_snapshot_missing_log(log_backend):
+    replicas = [Replica(durable=True)]
+    storage.save_snapshot(replicas, {"log_id": "x", "seq": 0})
+    replicas[0].destroy()
+    assert storage.load_snapshot() is None
+
+def test_remove_orphans(log_backend):
+    kept = Replica(durable=True)
+    kept["a"] = "1"
+    storage.save_snapshot([kept], {"log_id": "x", "seq": 0})
+    crash(kept)
+    orphan = log_backend / uuid.uuid4().hex
+    orphan.mkdir()
+    other = log_backend / "not-a-log"
+    other.mkdir()
+
+    storage.remove_orphans()
+    assert os.path.isdir(kept.values.path)
+    assert not orphan.exists()
+    assert other.exists()
+    Replica.load(kept.values.path).destroy()
+
+def test_remove_orphans_without_snapshot(log_backend):
+    # after a crash before the first checkpoint, no log is known to be dead
+    log = log_backend / uuid.uuid4().hex
+    log.mkdir()
+    storage.remove_orphans()
+    assert log.exists()
@@ -0,0 +1,79 @@
+import socket
+import threading
+
+import pytest
+
+from stream_transport import StreamServer, StreamSender
+
+
+def free_addr():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return f"127.0.0.1:{s.getsockname()[1]}"
+
+class Received:
+    def __init__(self):
+        self.cv = threading.Condition()
+        self.frames = []
+
+    def __call__(self, endpoint, data):
+        with self.cv:
+            self.frames.append((endpoint, data))
+            self.cv.notify_all()
+
+    def wait(self, count):
+        with self.cv:
+            assert self.cv.wait_for(lambda: len(self.frames) >= count, timeout=5)
+            return list(self.frames)
+
+@pytest.fixture
+def server():
+    received = Received()
+    server = StreamServer(free_addr(), received)
+    server.start()
+    yield server, received
+    server.listener.close()
+
+
+def test_frames_arrive_in_order(server):
+    server, received = server
+    sender = StreamSender("node", server.addr)
+    for i in range(100):
+        assert sender.submit("modify", {"seq": i})
+    assert received.wait(100) == [("modify", {"seq": i}) for i in range(100)]
+    sender.close()
+
+def test_resend_on_new_connection(server):
+    server, received = server
+    sender = StreamSender("node", server.addr)
+    sender.submit("modify", {"seq": 0})
+    received.wait(1)
+    sender.conn.close() # the connection breaks while the sender is idle
+    sender.submit("modify", {"seq": 1})
+    assert received.wait(2) == [("modify", {"seq": 0}), ("modify", {"seq": 1})]
+    assert sender.reconnects == 1
+    assert server.connections == 2
+    sender.close()
+
+def test_unreachable_peer_hands_back_frames():
+    failed = []
+    done = threading.Event()
+    def on_failure(sender, unsent):
+        failed.extend(unsent)
+        done.set()
+    sender = StreamSender("node", free_addr(), on_failure=on_failure)
+    sender.submit("modify", {"seq": 0})
+    assert done.wait(5)
+    assert failed == [("modify", {"seq": 0})]
+    assert not sender.submit("modify", {"seq": 1})
+
+def test_rejects_peers_outside_the_ring():
+    received = Received()
+    server = StreamServer(free_addr(), received, allow_peer=lambda ip: False)
+    server.start()
+    with socket.create_connection(("127.0.0.1", int(server.addr.rsplit(":", 1)[1]))) as conn:
+        conn.settimeout(5)
+        assert conn.recv(1) == b"" # closed without reading
+    assert server.rejected == 1
+    assert received.frames == []
+    server.listener.close()
@@ -0,0 +1,23 @@
+import json
+import zlib
+
+# Bulk key handoff (joinResponse, departPred, shiftDownReplicas) is sent as a sequence of
+# bounded, zlib-compressed chunks instead of one JSON body holding whole replicas.
+# Chunk payload: compressed JSON list of [key, value] pairs, in hash order.
+
+def iter_chunks(items, max_bytes):
+    chunk, size = [], 0
+    for key, value in items:
+        chunk.append([key, value])
+        size += len(key) + len(value) + 8
+        if size >= max_bytes:
+            yield chunk
+            chunk, size = [], 0
+    if chunk:
+        yield chunk
+
+def encode_chunk(pairs, level=1):
+    return zlib.compress(json.dumps(pairs).encode(), level)
+
+def decode_chunk(body):
+    return json.loads(zlib.decompress(body))